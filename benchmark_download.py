@@ -0,0 +1,89 @@
+# coding: utf-8
+# Runs download.download() against local fake_flickr_api.py server and reports throughput
+import sys
+import os
+import time
+import shutil
+import argparse
+import leveldb
+import build_queue
+import download
+import fake_flickr_api
+from lib.photo_data import get_owners_db_filename
+
+
+def make_queue(queue_filename, max_date):
+    if os.path.exists(queue_filename):
+        os.remove(queue_filename)
+    db = build_queue.get_queue_db(queue_filename)
+    job = build_queue.get_root_job()
+    job.update({'overflow_expected': 1, 'max_date': max_date})
+    with db:
+        build_queue.put_job(db, job)
+    db.close()
+
+
+def count_photos(photo_db_filename):
+    db = leveldb.LevelDB(photo_db_filename)
+    return sum(1 for _ in db.RangeIter(include_value=False, fill_cache=False))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--temp-dir', required=True)
+    parser.add_argument('--photos', type=int, default=100000)
+    parser.add_argument('--clusters', type=int, default=50)
+    parser.add_argument('--cluster-share', type=float, default=0.8)
+    parser.add_argument('--latency', type=float, default=0.05, help='mean response time, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.)
+    parser.add_argument('--throttle-rps', type=float, help='fake server responds 429 above this requests rate')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs-in-flight', type=int, default=1)
+    parser.add_argument('--prefetch-jobs', type=int, default=0)
+    parser.add_argument('--group-commit-jobs', type=int, default=1)
+    parser.add_argument('--group-commit-time', type=float, default=5)
+    parser.add_argument('-r', '--max-rps', type=float)
+    parser.add_argument('-v', '--verbose', action='store_true', help='show downloader output')
+    conf = parser.parse_args()
+
+    if not os.path.exists(conf.temp_dir):
+        os.makedirs(conf.temp_dir)
+    queue_filename = os.path.join(conf.temp_dir, 'benchmark_queue')
+    photo_db_filename = os.path.join(conf.temp_dir, 'benchmark_photos')
+    for filename in [photo_db_filename, get_owners_db_filename(photo_db_filename)]:
+        if os.path.exists(filename):
+            shutil.rmtree(filename)
+
+    print 'Generating photos'
+    api = fake_flickr_api.FakeFlickrApi(conf.photos, conf.clusters, conf.cluster_share, latency=conf.latency,
+                                        error_rate=conf.error_rate, throttle_rps=conf.throttle_rps, seed=conf.seed)
+    server = fake_flickr_api.start_server(api)
+    download.API_URL = fake_flickr_api.get_server_url(server)
+    download.rate_limiter.requests_per_second = conf.max_rps
+    make_queue(queue_filename, int(time.time()) + 600)
+
+    print 'Downloading'
+    stdout = sys.stdout
+    if not conf.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        totals = download.download(photo_db_filename, queue_filename, None, conf.jobs_in_flight,
+                                   group_commit_jobs=conf.group_commit_jobs, group_commit_time=conf.group_commit_time,
+                                   prefetch_jobs=conf.prefetch_jobs)
+    finally:
+        sys.stdout = stdout
+    server.shutdown()
+
+    photos_n = count_photos(photo_db_filename)
+    total_time = totals['time']
+    print 'Time: %.1f s' % total_time
+    print 'Jobs: %d, jobs/s: %.1f' % (totals['jobs'], totals['jobs'] / total_time)
+    print 'Requests: %d (server got %d, errors %d, throttled %d), requests/s: %.1f' % (
+        totals['reqs'], api.requests_n, api.errors_n, api.throttled_n, api.requests_n / total_time)
+    print 'Photos stored: %d of %d, requests per photo: %.4f' % (
+        photos_n, api.photos_n, float(api.requests_n) / max(photos_n, 1))
+    print 'DB time share: %.1f%%' % (totals['db_time'] / total_time * 100)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,30 @@
 # coding: utf-8
-import sys
 import os
 import sqlite3
 import leveldb
 import shutil
 import struct
-from lib.photo_data import unpack_row
-from lib.zorder import to_morton_3d_approx
+from array import array
+from lib import split_chunks
+from lib.photo_data import unpack_location
+from lib.zorder import to_morton_3d_approx, to_morton_3d_approx_np
+from lib.snapshot import open_snapshot, iterate_rows
+import numpy as np
 import time
 import argparse
+import multiprocessing
+import functools
+import contextlib
 
 
 margin_time = 1000
 margin_lat = 0.0004
 margin_lon = 0.0004
 max_results_in_request = 3500
+max_points_for_density = 100000
+coords_q = 10000000
+# for parallel planning, more cells than processes to balance load
+cells_per_process = 8
 
 
 point_fmt = '<iiI'
@@ -29,8 +39,7 @@ def unpack_point(s):
 
 
 def get_lat_lon_time_from_record(s):
-    photo = unpack_row(s)
-    return photo.lat_e7, photo.lon_e7, photo.upload_date
+    return unpack_location(s)
 
 
 def build_sorted_points_db(src_db, temp_dir):
@@ -53,7 +62,24 @@ def build_sorted_points_db(src_db, temp_dir):
     return sorted_db
 
 
-def build_tree(uniq_db, temp_dir):
+def iterate_sorted_points(sorted_db):
+    for _, v in sorted_db.RangeIter(fill_cache=False):
+        yield unpack_point(v)
+
+
+def iterate_snapshot_sorted_points(snapshot_dir):
+    # same order as in db from build_sorted_points_db: by morton code, then by photo id key
+    snapshot = open_snapshot(snapshot_dir)
+    lon = snapshot['lon_e7']
+    lat = snapshot['lat_e7']
+    ts = snapshot['upload_date']
+    z = to_morton_3d_approx_np(lon.astype(np.int64) + 1800000000, lat.astype(np.int64) + 1800000000, ts)
+    order = np.argsort(z, kind='mergesort')
+    del z
+    return iterate_rows([lon[order], lat[order], ts[order]])
+
+
+def build_tree(points, temp_dir):
     tree_filename = os.path.join(temp_dir, 'flickr_tree_3d_tmp')
     if os.path.exists(tree_filename):
         os.remove(tree_filename)
@@ -64,49 +90,125 @@ def build_tree(uniq_db, temp_dir):
         PRAGMA cache_size=-200000;
         CREATE VIRTUAL TABLE point USING rtree_i32(id, min_lat, max_lat, min_lon, max_lon, min_upload_date, max_upload_date);
     ''')
-    for i, (k, v) in enumerate(uniq_db.RangeIter(fill_cache=False), 1):
-        lon, lat, ts = unpack_point(v)
-        tree.execute('INSERT INTO point VALUES (?, ?, ?, ?, ?, ?, ?)',
-                     (i, lat, lat, lon, lon, ts, ts))
+    # points come in morton order, so consecutive inserts touch the same rtree nodes
+    t = time.time()
+    n = 0
+    chunk_size = 10000
+    for chunk in split_chunks(enumerate(points, 1), chunk_size):
+        rows = [(i, lat, lat, lon, lon, ts, ts) for i, (lon, lat, ts) in chunk]
+        tree.executemany('INSERT INTO point VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        n += len(rows)
     tree.commit()
+    print 'Indexed %d points, %.0f points/s' % (n, n / max(time.time() - t, 1e-6))
     return tree
 
 
+# Bounds are stored as integers: coordinates in 1e-7 degrees, dates in seconds
+queue_schema = '''
+    CREATE TABLE IF NOT EXISTS queue (
+      id INTEGER PRIMARY KEY,
+      priority INTEGER NOT NULL,
+      overflow_expected BOOL,
+      flag BOOL,
+      min_lat_e7 INTEGER,
+      max_lat_e7 INTEGER,
+      min_lon_e7 INTEGER,
+      max_lon_e7 INTEGER,
+      min_date INTEGER,
+      max_date INTEGER,
+      claimed_by TEXT,
+      lease_expires NUMBER
+    );
+'''
+
+queue_indexes = '''
+    CREATE INDEX IF NOT EXISTS idx_queue_order_id ON queue(priority DESC, id DESC);
+    CREATE INDEX IF NOT EXISTS idx_queue_flag ON queue(priority DESC, id DESC) WHERE flag = 1;
+    CREATE INDEX IF NOT EXISTS idx_queue_claimed_by ON queue(claimed_by) WHERE claimed_by IS NOT NULL;
+'''
+
+
 def get_queue_db(filename):
     queue_db = sqlite3.connect(filename)
-    queue_db.executescript('''
-        CREATE TABLE IF NOT EXISTS queue (
-          id INTEGER PRIMARY KEY,
-          priority INTEGER NOT NULL,
-          overflow_expected BOOL,
-          flag BOOL,
-          min_lat NUMBER,
-          max_lat NUMBER,
-          min_lon NUMBER,
-          max_lon NUMBER,
-          min_date INTEGER,
-          max_date INTEGER
-        );
-        
-        CREATE INDEX IF NOT EXISTS idx_queue_order_id ON queue(priority DESC, id DESC);
-  ''')
+    queue_db.executescript(queue_schema)
+    upgrade_queue_db(queue_db)
     return queue_db
 
 
-def check_points_count_exceeds(tree, job, max_points):
+@contextlib.contextmanager
+def immediate_transaction(db):
+    # write lock is taken at start, so other processes wait instead of interleaving reads and writes
+    isolation_level = db.isolation_level
+    db.isolation_level = None
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        yield
+    except:
+        db.execute('ROLLBACK')
+        raise
+    else:
+        db.execute('COMMIT')
+    finally:
+        db.isolation_level = isolation_level
+
+
+def get_queue_columns(queue_db):
+    return [row[1] for row in queue_db.execute('PRAGMA table_info(queue)')]
+
+
+def upgrade_queue_db(queue_db):
+    if not set(['claimed_by', 'min_lat_e7']) - set(get_queue_columns(queue_db)):
+        queue_db.executescript(queue_indexes)
+        return
+    with immediate_transaction(queue_db):
+        # checked again under lock, db could be upgraded by another process meanwhile
+        columns = get_queue_columns(queue_db)
+        if 'claimed_by' not in columns:
+            queue_db.execute('ALTER TABLE queue ADD COLUMN claimed_by TEXT')
+            queue_db.execute('ALTER TABLE queue ADD COLUMN lease_expires NUMBER')
+        if 'min_lat_e7' not in columns:
+            # old queue with float coordinates
+            queue_db.execute('ALTER TABLE queue RENAME TO queue_old')
+            queue_db.execute(queue_schema)
+            queue_db.execute('''
+                INSERT INTO queue
+                  SELECT id, priority, overflow_expected, flag,
+                    CAST(round(min_lat * %d) AS INTEGER), CAST(round(max_lat * %d) AS INTEGER),
+                    CAST(round(min_lon * %d) AS INTEGER), CAST(round(max_lon * %d) AS INTEGER),
+                    min_date, max_date, claimed_by, lease_expires
+                  FROM queue_old''' % ((coords_q,) * 4))
+            queue_db.execute('DROP TABLE queue_old')
+    queue_db.executescript(queue_indexes)
+
+
+def get_padded_bounds(job):
+    # integer bounds of job with margin, points are counted in [min, max) along each axis
     job = pad_job_with_margin(job)
-    coords_q = 10000000
     min_lat = int(round(job['min_lat'] * coords_q))
     max_lat = int(round(job['max_lat'] * coords_q))
     min_lon = int(round(job['min_lon'] * coords_q))
     max_lon = int(round(job['max_lon'] * coords_q))
-    cnt = tree.execute('''
+    return {
+        'lat': (min_lat, max_lat),
+        'lon': (min_lon, max_lon),
+        'upload_date': (job['min_date'], job['max_date'])
+    }
+
+
+def count_points(tree, job, max_points):
+    # returns min(number of points in job with margin, max_points + 1)
+    # A precomputed count tree over lat/lon/upload_date was tried here and was about 2 times slower than
+    # the rtree scan, which stops after max_points + 1 entries.
+    bounds = get_padded_bounds(job)
+    return tree.execute('''
       SELECT count(1) FROM (SELECT 1 FROM point
       WHERE min_lat >= ? AND min_lat < ? AND min_lon >= ? AND min_lon < ? AND
       min_upload_date >= ? AND min_upload_date < ? LIMIT ?)''',
-                         (min_lat, max_lat, min_lon, max_lon, job['min_date'], job['max_date'], max_points + 1)).fetchone()[0]
-    return cnt > max_points
+                        bounds['lat'] + bounds['lon'] + bounds['upload_date'] + (max_points + 1,)).fetchone()[0]
+
 
+def check_points_count_exceeds(tree, job, max_points):
+    return count_points(tree, job, max_points) > max_points
 
 
 def select_axis_for_split(job):
@@ -145,6 +247,30 @@ def split_job(job):
     return new_jobs
 
 
+def split_job_for_total(job, total, tree=None):
+    # Split overflowed job at once into as many parts as needed for `total` photos to fit
+    # into requests. Photos are expected to be distributed between halves like points in tree
+    # (from previous queue build) or evenly if tree is not given or is too dense to count.
+    queue = [(float(total), job)]
+    new_jobs = []
+    while queue:
+        expected, job = queue.pop()
+        if expected <= max_results_in_request or check_job_too_small(job):
+            new_jobs.append(job)
+            continue
+        parts = split_job(job)
+        if tree is not None:
+            counts = [count_points(tree, part, max_points_for_density) for part in parts]
+        if tree is None or max(counts) > max_points_for_density:
+            counts = [1, 1]
+        else:
+            counts = [c + 1 for c in counts]
+        for part, cnt in zip(parts, counts):
+            queue.append((expected * cnt / sum(counts), part))
+    new_jobs.reverse()
+    return new_jobs
+
+
 def pad_job_with_margin(job):
     job = dict(job)
     if job['max_lat'] - job['min_lat'] > margin_lat:
@@ -167,19 +293,34 @@ def check_job_too_small(job):
     )
 
 
+def get_job_row(job):
+    return (job['priority'], job['overflow_expected'],
+            int(round(job['min_lat'] * coords_q)), int(round(job['max_lat'] * coords_q)),
+            int(round(job['min_lon'] * coords_q)), int(round(job['max_lon'] * coords_q)),
+            job['min_date'], job['max_date'])
+
+
+def get_job_from_row(row):
+    job = dict(zip(row.keys(), row))
+    for key in ['min_lat', 'max_lat', 'min_lon', 'max_lon']:
+        value = job.pop(key + '_e7')
+        # flag rows have no bounds
+        job[key] = None if value is None else value / float(coords_q)
+    return job
+
+
+def put_jobs(queue_db, jobs):
+    queue_db.executemany('''INSERT INTO queue (priority, overflow_expected, min_lat_e7, max_lat_e7, min_lon_e7, max_lon_e7,
+                                              min_date, max_date)
+                            VALUES (?,?,?,?,?,?,?,?)''', (get_job_row(job) for job in jobs))
+
+
 def put_job(queue_db, job):
-    queue_db.execute('''INSERT INTO queue (priority, overflow_expected, min_lat, max_lat, min_lon, max_lon, min_date, max_date) 
-                        VALUES (?,?,?,?,?,?,?,?)''',
-                     (job['priority'], job['overflow_expected'], job['min_lat'], job['max_lat'],
-                      job['min_lon'], job['max_lon'], job['min_date'], job['max_date']))
+    put_jobs(queue_db, [job])
 
 
-def build_queue(queue_filename, tree, add_flag):
-    queue_db = get_queue_db(queue_filename)
-    requests_n = 0
-    n = 1
-    t = time.time()
-    queue = [{
+def get_root_job():
+    return {
         'min_lat': -90.,
         'max_lat': 90.,
         'min_lon': -180.,
@@ -188,23 +329,264 @@ def build_queue(queue_filename, tree, add_flag):
         'max_date': int(time.time()) + 600,
         'priority': 1,
         'overflow_expected': 0,
-        'flag': 0}]
-    first_result = True
+        'flag': 0}
+
+
+def walk_plan_with_tree(tree, root_job, root_path=''):
+    # Yields (path, job, points count, is_leaf) for every node of split tree in depth-first order,
+    # leaves are jobs for queue. Path of a child is path of its parent plus split_job() index.
+    # Counts are capped at max_results_in_request + 1.
+    queue = [(root_path, root_job)]
     while queue:
-        requests_n += 1
-        job = queue.pop()
-        if check_points_count_exceeds(tree, job, max_results_in_request) and not check_job_too_small(job):
-            queue.extend(split_job(job))
-        else:
-            if first_result:
-                queue_db.execute('INSERT INTO queue(priority, flag) VALUES (?,?)', (1, 1))
-            put_job(queue_db, job)
+        path, job = queue.pop()
+        count = count_points(tree, job, max_results_in_request)
+        is_leaf = count <= max_results_in_request or check_job_too_small(job)
+        yield path, job, count, is_leaf
+        if not is_leaf:
+            queue.extend(zip([path + '0', path + '1'], split_job(job)))
+
+
+def load_points(src_db):
+    lats = array('i')
+    lons = array('i')
+    timestamps = array('I')
+    for _, v in src_db.RangeIter(fill_cache=False):
+        lat, lon, ts = get_lat_lon_time_from_record(v)
+        lats.append(lat)
+        lons.append(lon)
+        timestamps.append(ts)
+    return {
+        'lat': np.frombuffer(lats, dtype=np.int32),
+        'lon': np.frombuffer(lons, dtype=np.int32),
+        'upload_date': np.frombuffer(timestamps, dtype=np.uint32)
+    }
+
+
+def load_snapshot_points(snapshot_dir):
+    snapshot = open_snapshot(snapshot_dir)
+    return {'lat': snapshot['lat_e7'], 'lon': snapshot['lon_e7'], 'upload_date': snapshot['upload_date']}
+
+
+def sort_points(points):
+    # sorting by morton code makes points of small jobs close in memory
+    z = to_morton_3d_approx_np(points['lon'].astype(np.int64) + 1800000000,
+                               points['lat'].astype(np.int64) + 1800000000, points['upload_date'])
+    order = np.argsort(z)
+    del z
+    return {'lat': points['lat'][order], 'lon': points['lon'][order], 'upload_date': points['upload_date'][order]}
+
+
+def select_points(points, job, indexes=None):
+    # returns indexes of points in job with margin, optionally only among given indexes
+    mask = None
+    for axis, (min_value, max_value) in get_padded_bounds(job).items():
+        values = points[axis] if indexes is None else points[axis][indexes]
+        axis_mask = (values >= min_value) & (values < max_value)
+        mask = axis_mask if mask is None else mask & axis_mask
+    if indexes is None:
+        return np.nonzero(mask)[0]
+    return indexes[mask]
+
+
+def count_points_in_arrays(points, job):
+    return len(select_points(points, job))
+
+
+def select_points_for_split(points, indexes, job, axis):
+    # Padded box of a child job lies inside padded box of its parent and differs only along split axis,
+    # so points of a child are found by filtering points of its parent by one coordinate.
+    values = points[axis][indexes]
+    min_value, max_value = get_padded_bounds(job)[axis]
+    return indexes[(values >= min_value) & (values < max_value)]
+
+
+def walk_plan_with_points(points, root_job, root_path='', indexes=None):
+    # Same as walk_plan_with_tree, but counts are exact and come from in-memory arrays.
+    if indexes is None:
+        indexes = select_points(points, root_job)
+    queue = [(root_path, root_job, indexes)]
+    while queue:
+        path, job, indexes = queue.pop()
+        is_leaf = len(indexes) <= max_results_in_request or check_job_too_small(job)
+        yield path, job, len(indexes), is_leaf
+        if not is_leaf:
+            axis = select_axis_for_split(job)
+            for i, new_job in enumerate(split_job(job)):
+                queue.append((path + str(i), new_job, select_points_for_split(points, indexes, new_job, axis)))
+
+
+def split_root_job(root_job, count_points_in_job, min_cells):
+    # Splits root job the same way planners do until there are at least min_cells independent cells.
+    # Returns plan nodes above cells and (path, job) of cells in split order,
+    # planners emit jobs of the last cell first.
+    nodes = []
+    cells = [('', root_job)]
+    while len(cells) < min_cells:
+        new_cells = []
+        for path, job in cells:
+            count = count_points_in_job(job)
+            if count > max_results_in_request and not check_job_too_small(job):
+                nodes.append((path, job, count, False))
+                new_cells.extend(zip([path + '0', path + '1'], split_job(job)))
+            else:
+                new_cells.append((path, job))
+        if len(new_cells) == len(cells):
+            break
+        cells = new_cells
+    return nodes, cells
+
+
+def split_root_job_with_points(points, root_job, min_cells):
+    # Same as split_root_job with exact counts, points of cells are selected among points of their parents.
+    # Returns nodes, cells and indexes of points of cells.
+    nodes = []
+    cells = [('', root_job, select_points(points, root_job))]
+    while len(cells) < min_cells:
+        new_cells = []
+        for path, job, indexes in cells:
+            if len(indexes) > max_results_in_request and not check_job_too_small(job):
+                nodes.append((path, job, len(indexes), False))
+                axis = select_axis_for_split(job)
+                for i, new_job in enumerate(split_job(job)):
+                    new_cells.append((path + str(i), new_job, select_points_for_split(points, indexes, new_job, axis)))
+            else:
+                new_cells.append((path, job, indexes))
+        if len(new_cells) == len(cells):
+            break
+        cells = new_cells
+    return nodes, [(path, job) for path, job, _ in cells], [indexes for _, _, indexes in cells]
+
+
+# set before starting worker processes, inherited by fork
+_worker_points = None
+_worker_cells_indexes = None
+_worker_tree = None
+
+
+def _init_tree_worker(tree_filename):
+    global _worker_tree
+    _worker_tree = sqlite3.connect(tree_filename)
+
+
+def _plan_cell_with_points((path, job, cell)):
+    return list(walk_plan_with_points(_worker_points, job, path, _worker_cells_indexes[cell]))
+
+
+def _plan_cell_with_tree((path, job)):
+    return list(walk_plan_with_tree(_worker_tree, job, path))
+
+
+def walk_plan_parallel(nodes, cells, processes, plan_cell, initializer=None, initargs=()):
+    # results are merged in the order sequential planner would produce them
+    for node in nodes:
+        yield node
+    pool = multiprocessing.Pool(processes, initializer, initargs)
+    try:
+        for cell_nodes in pool.imap(plan_cell, reversed(cells)):
+            for node in cell_nodes:
+                yield node
+    finally:
+        pool.terminate()
+
+
+def get_plan_db(filename):
+    plan_db = sqlite3.connect(filename)
+    plan_db.executescript('''
+        PRAGMA synchronous = off;
+        CREATE TABLE IF NOT EXISTS plan_node (
+          path TEXT PRIMARY KEY,
+          is_leaf BOOL,
+          points_count INTEGER,
+          min_lat NUMBER,
+          max_lat NUMBER,
+          min_lon NUMBER,
+          max_lon NUMBER,
+          min_date INTEGER,
+          max_date INTEGER
+        );
+    ''')
+    return plan_db
+
+
+def put_plan_nodes(plan_db, nodes):
+    plan_db.executemany('''INSERT OR REPLACE INTO plan_node
+                           (path, is_leaf, points_count, min_lat, max_lat, min_lon, max_lon, min_date, max_date)
+                           VALUES (?,?,?,?,?,?,?,?,?)''',
+                        ((path, is_leaf, count, job['min_lat'], job['max_lat'], job['min_lon'], job['max_lon'],
+                          job['min_date'], job['max_date']) for path, job, count, is_leaf in nodes))
+
+
+def get_plan_node(plan_db, path):
+    row = plan_db.execute('''SELECT is_leaf, points_count, min_lat, max_lat, min_lon, max_lon, min_date, max_date
+                             FROM plan_node WHERE path=?''', (path,)).fetchone()
+    if row is None:
+        return None
+    job = get_root_job()
+    is_leaf, count, job['min_lat'], job['max_lat'], job['min_lon'], job['max_lon'], job['min_date'], job['max_date'] = row
+    return path, job, count, is_leaf
+
+
+def delete_plan_subtree(plan_db, path):
+    plan_db.execute("DELETE FROM plan_node WHERE path >= ? AND path < ?", (path, path + '2'))
+
+
+def build_queue(queue_filename, nodes, add_flag, plan_db=None):
+    queue_db = get_queue_db(queue_filename)
+    if plan_db is not None:
+        plan_db.execute('DELETE FROM plan_node')
+    first_result = True
+    for chunk in split_chunks(nodes, 10000):
+        chunk = list(chunk)
+        jobs = [job for path, job, count, is_leaf in chunk if is_leaf]
+        if jobs and first_result:
+            queue_db.execute('INSERT INTO queue(priority, flag) VALUES (?,?)', (1, 1))
             first_result = False
-            n += 1
-            # FIXME: remove debug print
-            # print '\r', n, '%.3f' % ((time.time() - t) / requests_n * 1000),
-            sys.stdout.flush()
+        put_jobs(queue_db, jobs)
+        if plan_db is not None:
+            put_plan_nodes(plan_db, chunk)
     queue_db.commit()
+    if plan_db is not None:
+        plan_db.commit()
+
+
+def check_count_changed(old_count, new_count, threshold):
+    return abs(new_count - old_count) > threshold * old_count
+
+
+def replan_with_points(points, plan_db, threshold):
+    # Walks saved plan top-down and yields jobs for leaves where number of points changed by more than
+    # threshold (relative to count at plan time). Small relative changes of big internal nodes can hide
+    # big changes of their leaves, so internal nodes with changed count are always descended, their counts
+    # are updated. Photos are never deleted from photo db, so subtree with unchanged count is skipped.
+    # Overflowed leaves are split further, subtrees that fit in one request are merged.
+    root = get_plan_node(plan_db, '')
+    if root is None:
+        raise Exception('Plan is empty, run full mode with plan db first')
+    queue = [(root, select_points(points, root[1]))]
+    while queue:
+        (path, job, old_count, is_leaf), indexes = queue.pop()
+        count = len(indexes)
+        need_split = count > max_results_in_request and not check_job_too_small(job)
+        if is_leaf and not need_split:
+            if check_count_changed(old_count, count, threshold):
+                put_plan_nodes(plan_db, [(path, job, count, True)])
+                yield job
+        elif not need_split:
+            delete_plan_subtree(plan_db, path)
+            put_plan_nodes(plan_db, [(path, job, count, True)])
+            yield job
+        elif is_leaf:
+            delete_plan_subtree(plan_db, path)
+            for node in walk_plan_with_points(points, job, path, indexes):
+                put_plan_nodes(plan_db, [node])
+                if node[3]:
+                    yield node[1]
+        elif count != old_count:
+            put_plan_nodes(plan_db, [(path, job, count, False)])
+            axis = select_axis_for_split(job)
+            for i in [0, 1]:
+                child = get_plan_node(plan_db, path + str(i))
+                queue.append((child, select_points_for_split(points, indexes, child[1], axis)))
 
 
 def queue_recent(queue_filename, days, add_flag):
@@ -216,34 +598,100 @@ def queue_recent(queue_filename, days, add_flag):
     with db:
         if add_flag:
             db.execute('INSERT INTO queue(priority, flag) VALUES (?,?)', (priority, 1))
-        db.execute('''INSERT INTO queue (priority, overflow_expected, flag, min_lat, max_lat, min_lon, max_lon, min_date, max_date) 
-                      VALUES (?,?,?,?,?,?,?,?,?)''', (priority, 1, 0, -90., 90., -180., 180., ts1, ts2))
+        job = get_root_job()
+        job.update({'priority': priority, 'overflow_expected': 1, 'min_date': ts1, 'max_date': ts2})
+        put_job(db, job)
     db.close()
 
 
-def queue_all(queue_filename, src_db_filename, temp_dir, add_flag):
-    if not os.path.isdir(src_db_filename):
+def load_sorted_points(src_db_filename, snapshot_dir):
+    if snapshot_dir is None:
+        points = load_points(leveldb.LevelDB(src_db_filename, max_open_files=100))
+    else:
+        points = load_snapshot_points(snapshot_dir)
+    return sort_points(points)
+
+
+def queue_all(queue_filename, src_db_filename, temp_dir, add_flag, snapshot_dir=None, method='points',
+              processes=1, plan_db_filename=None):
+    global _worker_points, _worker_cells_indexes
+    if snapshot_dir is None and not os.path.isdir(src_db_filename):
         raise Exception('%s not found' % queue_filename)
     if not os.path.exists(temp_dir):
         os.makedirs(temp_dir)
+    plan_db = None
+    if plan_db_filename:
+        if method != 'points':
+            raise Exception('Saving plan requires exact counts, use points method')
+        plan_db = get_plan_db(plan_db_filename)
+
+    root_job = get_root_job()
+    if method == 'points':
+        points = load_sorted_points(src_db_filename, snapshot_dir)
+        if processes > 1:
+            root_nodes, cells, _worker_cells_indexes = split_root_job_with_points(points, root_job,
+                                                                                  processes * cells_per_process)
+            _worker_points = points
+            cells = [(path, job, i) for i, (path, job) in enumerate(cells)]
+            nodes = walk_plan_parallel(root_nodes, cells, processes, _plan_cell_with_points)
+        else:
+            nodes = walk_plan_with_points(points, root_job)
+        build_queue(queue_filename, nodes, add_flag, plan_db)
+        _worker_points = None
+        _worker_cells_indexes = None
+        return
 
-    src_db = leveldb.LevelDB(src_db_filename, max_open_files=100)
     # print 'Sorting'
     t = time.time()
-    points_db = build_sorted_points_db(src_db, temp_dir)
+    if snapshot_dir is None:
+        src_db = leveldb.LevelDB(src_db_filename, max_open_files=100)
+        points_db = build_sorted_points_db(src_db, temp_dir)
+        points = iterate_sorted_points(points_db)
+    else:
+        points = iterate_snapshot_sorted_points(snapshot_dir)
     # print time.time() - t
     # print 'Indexing'
     t = time.time()
-    tree = build_tree(points_db, temp_dir)
-    del points_db
+    tree = build_tree(points, temp_dir)
+    del points
     # print time.time() - t
     # print 'Building'
     t = time.time()
-    build_queue(queue_filename, tree, add_flag)
+    if processes > 1:
+        root_nodes, cells = split_root_job(root_job,
+                                           functools.partial(count_points, tree, max_points=max_results_in_request),
+                                           processes * cells_per_process)
+        nodes = walk_plan_parallel(root_nodes, cells, processes, _plan_cell_with_tree, _init_tree_worker,
+                                   (os.path.join(temp_dir, 'flickr_tree_3d_tmp'),))
+    else:
+        nodes = walk_plan_with_tree(tree, root_job)
+    build_queue(queue_filename, nodes, add_flag)
     # print time.time() - t
     tree.close()
 
 
+def queue_changed(queue_filename, src_db_filename, plan_db_filename, threshold, add_flag, snapshot_dir=None):
+    # Only time range of the saved plan is covered, photos uploaded after it are queued by recent mode
+    if snapshot_dir is None and not os.path.isdir(src_db_filename):
+        raise Exception('%s not found' % src_db_filename)
+    if not os.path.exists(plan_db_filename):
+        raise Exception('%s not found' % plan_db_filename)
+    plan_db = get_plan_db(plan_db_filename)
+    # not sorted, only few subtrees are descended
+    if snapshot_dir is None:
+        points = load_points(leveldb.LevelDB(src_db_filename, max_open_files=100))
+    else:
+        points = load_snapshot_points(snapshot_dir)
+    queue_db = get_queue_db(queue_filename)
+    jobs = list(replan_with_points(points, plan_db, threshold))
+    if jobs and add_flag:
+        queue_db.execute('INSERT INTO queue(priority, flag) VALUES (?,?)', (1, 1))
+    put_jobs(queue_db, jobs)
+    queue_db.commit()
+    plan_db.commit()
+    print 'Queued', len(jobs), 'jobs'
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-q', '--queue-db', required=True)
@@ -251,15 +699,29 @@ def main():
     subparsers = parser.add_subparsers(dest='command')
     parser_all = subparsers.add_parser('full')
     parser_recent = subparsers.add_parser('recent')
-    parser_all.add_argument('-p', '--photo-db', required=True)
+    parser_changed = subparsers.add_parser('changed', help='queue only regions changed since plan was saved')
+    for subparser in [parser_all, parser_changed]:
+        src_group = subparser.add_mutually_exclusive_group(required=True)
+        src_group.add_argument('-p', '--photo-db')
+        src_group.add_argument('-s', '--snapshot', help='columnar snapshot made by export_snapshot.py')
     parser_all.add_argument('-t', '--temp-dir', required=True)
+    parser_all.add_argument('-m', '--method', choices=['points', 'tree'], default='points',
+                            help='count points in jobs with in-memory arrays or with rtree index')
+    parser_all.add_argument('-j', '--processes', type=int, default=1, help='plan queue in parallel processes')
+    parser_all.add_argument('-P', '--plan-db', help='save split tree for changed mode')
+    parser_changed.add_argument('-P', '--plan-db', required=True)
+    parser_changed.add_argument('--threshold', type=float, default=0.1,
+                                help='relative change of points count in a job to queue it again')
     parser_recent.add_argument('-d', '--days', type=int, required=True)
     conf = parser.parse_args()
     if conf.command == 'recent':
         queue_recent(conf.queue_db, conf.days, conf.flag)
+    elif conf.command == 'changed':
+        queue_changed(conf.queue_db, conf.photo_db, conf.plan_db, conf.threshold, conf.flag, conf.snapshot)
     else:
-        queue_all(conf.queue_db, conf.photo_db, conf.temp_dir, conf.flag)
+        queue_all(conf.queue_db, conf.photo_db, conf.temp_dir, conf.flag, conf.snapshot, conf.method,
+                  conf.processes, conf.plan_db)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -6,12 +6,17 @@ import sqlite3
 import leveldb
 import time
 import json
+import socket
 import pyproj
+import Queue
+import collections
 from multiprocessing.dummy import Pool as ThreadPool
 from requests.adapters import HTTPAdapter
 import datetime
 import build_queue
-from lib.photo_data import pack_row, pack_id
+from lib import split_chunks
+from lib.photo_data import pack_row, pack_id, OwnerTable, get_owners_db_filename
+from lib.rate_limit import RateLimiter
 import argparse
 
 
@@ -19,25 +24,71 @@ proj_wgs84 = pyproj.Proj('+init=EPSG:4326')
 proj_gmerc = pyproj.Proj('+init=EPSG:3857')
 
 MAX_PHOTOS_PER_PAGE = 250
+MAX_CONCURRENT_REQUESTS = 20
+API_URL = 'https://api.flickr.com/services/rest/'
+LEASE_TIME = 600
+
+
+def claim_jobs(db, worker_id, max_jobs, lease_time):
+    # Jobs are selected and leased in one write transaction, so claim is atomic between processes
+    # sharing the queue db and only jobs leased by this call are returned.
+    # Jobs queued after a flag are not handed out until the flag is consumed,
+    # flag itself is handed out only when no jobs before it are left, claimed or not.
+    now = time.time()
+    with build_queue.immediate_transaction(db):
+        rows = db.execute('''
+          SELECT *
+          FROM queue AS j
+          WHERE (j.claimed_by IS NULL OR j.lease_expires < ?)
+            AND NOT EXISTS (
+              SELECT 1 FROM queue AS f
+              WHERE f.flag = 1 AND (f.priority > j.priority OR (f.priority = j.priority AND f.id > j.id)))
+            AND (coalesce(j.flag, 0) = 0 OR NOT EXISTS (
+              SELECT 1 FROM queue AS a
+              WHERE a.priority > j.priority OR (a.priority = j.priority AND a.id > j.id)))
+          ORDER BY j.priority DESC, j.id DESC
+          LIMIT ?''', (now, max_jobs)).fetchall()
+        for chunk in split_chunks([row['id'] for row in rows], 500):
+            chunk = list(chunk)
+            db.execute('UPDATE queue SET claimed_by = ?, lease_expires = ? WHERE id IN (%s)' % ','.join('?' * len(chunk)),
+                       [worker_id, now + lease_time] + chunk)
+    return [build_queue.get_job_from_row(row) for row in rows]
+
+
+def renew_leases(db, worker_id, job_ids, lease_time):
+    lease_expires = time.time() + lease_time
+    # chunked to stay below sqlite limit on number of parameters
+    for chunk in split_chunks(job_ids, 500):
+        chunk = list(chunk)
+        db.execute('UPDATE queue SET lease_expires = ? WHERE claimed_by = ? AND id IN (%s)' % ','.join('?' * len(chunk)),
+                   [lease_expires, worker_id] + chunk)
+    db.commit()
+
+
+def release_jobs(db, worker_id, job_ids):
+    for chunk in split_chunks(job_ids, 500):
+        chunk = list(chunk)
+        db.execute('UPDATE queue SET claimed_by = NULL, lease_expires = NULL WHERE claimed_by = ? AND id IN (%s)' %
+                   ','.join('?' * len(chunk)), [worker_id] + chunk)
+    db.commit()
 
 
-def get_job(db):
-    return db.execute('''
-      SELECT * 
-      FROM queue 
-      ORDER BY priority DESC, id DESC 
-      LIMIT 1''').fetchone()
+def queue_is_empty(db):
+    return not db.execute('SELECT EXISTS (SELECT 1 FROM queue)').fetchone()[0]
 
 
-def remove_job(db, job):
-    db.execute('DELETE FROM queue WHERE id=?', (job['id'],))
+def remove_job(db, job, worker_id):
+    # returns False if lease has expired and job was claimed by another worker
+    return db.execute('DELETE FROM queue WHERE id=? AND claimed_by=?', (job['id'], worker_id)).rowcount > 0
 
 
-def put_photos(db, photos):
+def put_photos(db, owners, photos, sync=False):
     batch = leveldb.WriteBatch()
     for photo in photos:
-        batch.Put(pack_id(photo['id']), pack_row(photo))
-    db.Write(batch)
+        batch.Put(pack_id(photo['id']), pack_row(photo, owners))
+    # new owners must be stored before rows referencing them
+    owners.flush(sync=sync)
+    db.Write(batch, sync=sync)
 
 
 def commit(db):
@@ -47,20 +98,45 @@ def commit(db):
 def get_queue_database(filename):
     if not os.path.exists(filename):
         raise Exception('File "%s" not found' % filename)
-    db = sqlite3.connect(filename)
+    db = sqlite3.connect(filename, timeout=60)
     db.row_factory = sqlite3.Row
+    build_queue.upgrade_queue_db(db)
     return db
 
 
 session = requests.Session()
-adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20)
+adapter = HTTPAdapter(pool_connections=MAX_CONCURRENT_REQUESTS, pool_maxsize=MAX_CONCURRENT_REQUESTS)
 session.mount("http://", adapter)
 session.mount("https://", adapter)
-pool = ThreadPool(20)
+pool = ThreadPool(MAX_CONCURRENT_REQUESTS)
+# shared by all jobs in flight, so total number of requests never exceeds MAX_CONCURRENT_REQUESTS
+rate_limiter = RateLimiter(MAX_CONCURRENT_REQUESTS)
+
+
+def request_json(url, params):
+    # returns (data, error), error is one of lib.rate_limit.backoff_delays keys
+    try:
+        resp = session.get(url, params=params, timeout=(3.05, 30))
+    except requests.Timeout:
+        return None, 'timeout'
+    except requests.RequestException:
+        return None, 'connection'
+    if resp.status_code == 429:
+        return None, 'throttled'
+    if resp.status_code >= 500:
+        return None, 'server'
+    try:
+        data = json.loads(resp.content)
+    except ValueError:
+        return None, 'malformed'
+    # proxies and error pages can return valid json which is not api response
+    if not isinstance(data, dict) or data.get('stat') != 'ok':
+        return None, 'api'
+    return data, None
 
 
 def get_page(job, per_page, page):
-    url = 'https://api.flickr.com/services/rest/'
+    url = API_URL
     job = build_queue.pad_job_with_margin(job)
     # min_lat, max_lat, min_lon, max_lon, min_date, max_date = job
     bounds_param = ','.join(map(str, [job['min_lon'], job['min_lat'], job['max_lon'], job['max_lat']]))
@@ -77,22 +153,23 @@ def get_page(job, per_page, page):
         'extras': 'geo,date_upload'
     }
     retries = 1000
+    attempt = 0
     while True:
+        rate_limiter.acquire()
+        error = 'unexpected'
         try:
-            resp = session.get(url, params=params, timeout=(3.05, 30))
-            data = resp.content
-            data = json.loads(data)
-            if data['stat'] != 'ok':
-                raise Exception('Invalid response: %r' % data)
-        except:
-            if not retries:
-                raise
-            retries -= 1
-            # FIXME: remove debug print
-            print 'Retrying'
-            time.sleep(1)
-        else:
+            data, error = request_json(url, params)
+        finally:
+            rate_limiter.release(error)
+        if error is None:
             break
+        if not retries:
+            raise Exception('Request failed: %s' % error)
+        retries -= 1
+        # FIXME: remove debug print
+        print 'Retrying', error
+        time.sleep(rate_limiter.get_backoff_delay(error, min(attempt, 20)))
+        attempt += 1
     return data['photos']
 
 
@@ -110,7 +187,7 @@ def get_photos(job, ignore_overflow):
         if total > 4000:
             # FIXME: remove debug print
             print 'Overflow', total, job
-            return {'overflow': True, 'reqs': reqs_n}
+            return {'overflow': True, 'total': total, 'reqs': reqs_n}
     pages = get_pages_parallel(job, [1, 2])
     reqs_n += 2
     total = int(pages[0]['total'])
@@ -123,7 +200,7 @@ def get_photos(job, ignore_overflow):
         else:
             # FIXME: remove debug print
             print 'Overflow', total, list(job)
-            return {'overflow': True, 'reqs': reqs_n}
+            return {'overflow': True, 'total': total, 'reqs': reqs_n}
     else:
         pages_n = int(pages[0]['pages'])
     page_numbers = range(3, pages_n + 2)
@@ -131,7 +208,7 @@ def get_photos(job, ignore_overflow):
     if total == 0:
         # FIXME: remove debug print
         print 'Empty'
-        return {'overflow': False, 'photos': [], 'reqs': 2}
+        return {'overflow': False, 'photos': [], 'reqs': reqs_n}
     # FIXME: remove debug print
     print 'Total', total, 'Pages', pages_n
     if page_numbers:
@@ -154,10 +231,61 @@ def signal_flag(flags_dir):
     open(os.path.join(flags_dir, flag_filename), 'w').close()
 
 
-def download(photo_db_filename, queue_db_filename, flags_dir):
+def fetch_job(job):
+    try:
+        job_is_small = build_queue.check_job_too_small(job)
+        return job, get_photos(job, ignore_overflow=job_is_small), None
+    except Exception:
+        return job, None, sys.exc_info()
+
+
+def commit_results(photo_db, owners, queue_db, results, worker_id, density_tree=None, sync=False):
+    # Photos are written first: if we crash before the queue is committed, the jobs are
+    # downloaded again and photos are just overwritten. Job removal and split jobs are
+    # committed in one transaction, so a job is never lost or split twice.
+    photos = [photo for _, job_photos in results if not job_photos['overflow'] for photo in job_photos['photos']]
+    put_photos(photo_db, owners, photos, sync=sync)
+    new_jobs = []
+    for job, job_photos in results:
+        lease_kept = remove_job(queue_db, job, worker_id)
+        if job_photos['overflow']:
+            # job with lost lease is split by worker which got it
+            if lease_kept:
+                new_jobs.extend(build_queue.split_job_for_total(job, job_photos['total'], density_tree))
+    build_queue.put_jobs(queue_db, new_jobs)
+    queue_db.commit()
+
+
+def download(photo_db_filename, queue_db_filename, flags_dir, jobs_in_flight=1, worker_id=None,
+             group_commit_jobs=1, group_commit_time=5, density_tree_filename=None, prefetch_jobs=0):
+    if worker_id is None:
+        worker_id = '%s:%d' % (socket.gethostname(), os.getpid())
+    # Photos db and its owners db are locked by this process until it exits: downloaders sharing a queue
+    # must write separate photos dbs (merge them with merge_photo_db.py), and other tools can not read
+    # them meanwhile.
     photo_db = leveldb.LevelDB(photo_db_filename)
+    owners = OwnerTable(get_owners_db_filename(photo_db_filename))
     queue_db = get_queue_database(queue_db_filename)
-    fetch_time = 0
+    density_tree = None
+    if density_tree_filename:
+        if not os.path.exists(density_tree_filename):
+            raise Exception('File "%s" not found' % density_tree_filename)
+        density_tree = sqlite3.connect(density_tree_filename)
+    jobs_pool = ThreadPool(jobs_in_flight)
+    results = Queue.Queue()
+    in_flight = {}
+    # results downloaded but not committed yet, their jobs are still leased
+    pending = []
+    pending_since = None
+    # fsync is paid once per group, also when group is flushed with one job by timeout or at the end;
+    # without group commit jobs are written as before
+    sync = group_commit_jobs > 1
+    # Jobs claimed ahead of time, so the queue is queried once per batch, not for every job.
+    # They are leased like jobs in flight. Jobs queued meanwhile with higher priority
+    # (e.g. splits of overflowed jobs) wait at most until the batch is used up.
+    prefetched = collections.deque()
+    leases_renewed_at = time.time()
+    totals = {'jobs': 0, 'jobs_with_data': 0, 'reqs': 0, 'db_time': 0, 'time': time.time()}
     db_time = 0
     reqs_n = 0
     t = time.time()
@@ -165,39 +293,73 @@ def download(photo_db_filename, queue_db_filename, flags_dir):
     jobs_with_data = 0
     results_n = 0
     while True:
-        t2 = time.time()
-        job = get_job(queue_db)
-        db_time += time.time() - t2
-        if not job:
-            break
-        if job['flag'] and flags_dir:
-            signal_flag(flags_dir)
-            remove_job(queue_db, job)
-            queue_db.commit()
+        claimed_ids = list(in_flight) + [job['id'] for job, _ in pending] + [job['id'] for job in prefetched]
+        if time.time() - leases_renewed_at > LEASE_TIME / 3:
+            renew_leases(queue_db, worker_id, claimed_ids, LEASE_TIME)
+            leases_renewed_at = time.time()
+        if pending and (len(pending) >= group_commit_jobs or time.time() - pending_since > group_commit_time):
+            t2 = time.time()
+            commit_results(photo_db, owners, queue_db, pending, worker_id, density_tree, sync)
+            pending = []
+            db_time += time.time() - t2
             continue
-        processed_jobs += 1
-        t2 = time.time()
-        job_is_small = build_queue.check_job_too_small(job)
-        photos = get_photos(job, ignore_overflow=job_is_small)
-        fetch_time += time.time() - t2
+        if len(in_flight) < jobs_in_flight:
+            if not prefetched:
+                t2 = time.time()
+                prefetched.extend(
+                    claim_jobs(queue_db, worker_id, jobs_in_flight - len(in_flight) + prefetch_jobs, LEASE_TIME))
+                db_time += time.time() - t2
+            jobs = [prefetched.popleft() for _ in xrange(min(len(prefetched), jobs_in_flight - len(in_flight)))]
+            for job in jobs:
+                if job['flag']:
+                    if flags_dir:
+                        signal_flag(flags_dir)
+                    remove_job(queue_db, job, worker_id)
+                    queue_db.commit()
+                else:
+                    in_flight[job['id']] = job
+                    jobs_pool.apply_async(fetch_job, (job,), callback=results.put)
+            if jobs:
+                continue
+            if pending:
+                # nothing to claim, probably waiting for splits of pending jobs
+                t2 = time.time()
+                commit_results(photo_db, owners, queue_db, pending, worker_id, density_tree, sync)
+                pending = []
+                db_time += time.time() - t2
+                continue
+            if not in_flight:
+                if queue_is_empty(queue_db):
+                    break
+                # remaining jobs are leased by other workers or wait behind a flag
+                time.sleep(1)
+                continue
 
-        t2 = time.time()
-        if photos['overflow']:
-            for new_job in build_queue.split_job(job):
-                build_queue.put_job(queue_db, new_job)
-        else:
+        try:
+            job, photos, exc_info = results.get(timeout=min(LEASE_TIME / 3, group_commit_time))
+        except Queue.Empty:
+            continue
+        del in_flight[job['id']]
+        if exc_info:
+            commit_results(photo_db, owners, queue_db, pending, worker_id, density_tree, sync)
+            release_jobs(queue_db, worker_id, [job['id'] for job in prefetched])
+            raise exc_info[0], exc_info[1], exc_info[2]
+        processed_jobs += 1
+        if not photos['overflow']:
             jobs_with_data += 1
             results_n += len(photos['photos'])
-            put_photos(photo_db, photos['photos'])
-        remove_job(queue_db, job)
-        queue_db.commit()
-        db_time += time.time() - t2
+        if not pending:
+            pending_since = time.time()
+        pending.append((job, photos))
         reqs_n += photos['reqs']
+        totals['jobs'] += 1
+        totals['jobs_with_data'] += not photos['overflow']
+        totals['reqs'] += photos['reqs']
 
         if time.time() - t > 60:
             queue_len = queue_db.execute('SELECT count(1) FROM queue').fetchone()[0]
             total_time = time.time() - t
-            rps = float(reqs_n) / fetch_time
+            rps = float(reqs_n) / total_time
             db_time_share = db_time / total_time * 100
             timestr = datetime.datetime.now().strftime('%d %H:%M:%S')
             jobs_per_second = float(processed_jobs) / total_time
@@ -212,7 +374,7 @@ def download(photo_db_filename, queue_db_filename, flags_dir):
                 'Hit rate: %.1f%%' %  jobs_with_data_share
 
             t = time.time()
-            fetch_time = 0
+            totals['db_time'] += db_time
             db_time = 0
             reqs_n = 0
             processed_jobs = 0
@@ -220,19 +382,63 @@ def download(photo_db_filename, queue_db_filename, flags_dir):
             # prev_photo_cnt = res_cnt
             results_n = 0
         sys.stdout.flush()
+    jobs_pool.close()
     print 'Done'
+    totals['db_time'] += db_time
+    totals['time'] = time.time() - totals['time']
+    return totals
 
 
 def main():
+    global API_URL
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--photo-db', required=True)
     parser.add_argument('-q', '--queue-db', required=True)
     parser.add_argument('-f', '--flags-dir')
+    parser.add_argument('-j', '--jobs-in-flight', type=int, default=1,
+                        help='number of jobs downloaded concurrently')
+    parser.add_argument('--prefetch-jobs', type=int, default=0,
+                        help='number of jobs claimed from queue ahead of download, '
+                             'jobs queued meanwhile with higher priority wait until they are used up')
+    parser.add_argument('-w', '--worker-id', help='unique id of this downloader, defaults to host:pid')
+    parser.add_argument('--group-commit-jobs', type=int, default=1,
+                        help='commit results of this many jobs at once')
+    parser.add_argument('--group-commit-time', type=float, default=5,
+                        help='max seconds results can wait for commit')
+    parser.add_argument('-t', '--density-tree',
+                        help='3d points tree from build_queue.py, used to split overflowed jobs by photos density')
+    parser.add_argument('-r', '--max-rps', type=float, help='max requests per second to API')
+    parser.add_argument('--api-url', default=API_URL, help='e.g. url of fake_flickr_api.py server')
     conf = parser.parse_args()
+    rate_limiter.requests_per_second = conf.max_rps
+    API_URL = conf.api_url
     if conf.flags_dir and not os.path.isdir(conf.flags_dir):
         raise Exception('Directory %s not found' % conf.flags_dir)
-    download(conf.photo_db, conf.queue_db, conf.flags_dir)
+    download(conf.photo_db, conf.queue_db, conf.flags_dir, conf.jobs_in_flight, conf.worker_id,
+             conf.group_commit_jobs, conf.group_commit_time, conf.density_tree, conf.prefetch_jobs)
+
+
+def check_claim_jobs():
+    # queue with flag before jobs, as written by build_queue.py
+    db = build_queue.get_queue_db(':memory:')
+    db.row_factory = sqlite3.Row
+    db.execute('INSERT INTO queue(priority, flag) VALUES (?,?)', (1, 1))
+    build_queue.put_jobs(db, [build_queue.get_root_job()] * 2)
+    db.commit()
+    first = claim_jobs(db, 'a', 1, LEASE_TIME)
+    second = claim_jobs(db, 'a', 10, LEASE_TIME)
+    assert len(first) == 1 and len(second) == 1 and first[0]['id'] != second[0]['id']
+    assert claim_jobs(db, 'b', 10, LEASE_TIME) == []
+    for job in first + second:
+        remove_job(db, job, 'a')
+    db.commit()
+    flags = claim_jobs(db, 'b', 10, LEASE_TIME)
+    assert len(flags) == 1 and flags[0]['flag'] and flags[0]['min_lat'] is None
+    print 'OK'
 
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:] == ['--check']:
+        check_claim_jobs()
+    else:
+        main()
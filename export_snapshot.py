@@ -0,0 +1,20 @@
+# coding: utf-8
+import time
+import argparse
+from lib.snapshot import export_snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--photo-db', required=True)
+    parser.add_argument('-s', '--snapshot', required=True, help='output directory')
+    conf = parser.parse_args()
+    t = time.time()
+    count = export_snapshot(conf.photo_db, conf.snapshot)
+    print
+    print 'Exported', count, 'photos'
+    print time.time() - t
+
+
+if __name__ == '__main__':
+    main()
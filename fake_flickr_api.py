@@ -0,0 +1,195 @@
+# coding: utf-8
+# Local stand-in for flickr.photos.search, for offline testing and benchmarking of download.py
+import sys
+import time
+import json
+import math
+import random
+import threading
+import urlparse
+import argparse
+import collections
+import BaseHTTPServer
+import SocketServer
+
+MAX_RESULTS = 4000
+MAX_PER_PAGE = 500
+cell_size = 1.
+
+
+def clamp(x, min_x, max_x):
+    return min(max_x, max(min_x, x))
+
+
+class FakeFlickrApi(object):
+    def __init__(self, photos_n=100000, clusters_n=50, cluster_share=0.8, min_date=1200000000, max_date=None,
+                 latency=0.05, error_rate=0., throttle_rps=None, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rps = throttle_rps
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.requests_n = 0
+        self.errors_n = 0
+        self.throttled_n = 0
+        self.recent_requests = collections.deque()
+        if max_date is None:
+            max_date = int(time.time())
+        self.photos_n = photos_n
+        self.cells = self.generate_photos(photos_n, clusters_n, cluster_share, min_date, max_date)
+
+    def generate_photos(self, photos_n, clusters_n, cluster_share, min_date, max_date):
+        # photos are (upload_date, id, lat, lon, accuracy, owner) tuples grouped by cells of cell_size degrees
+        rnd = self.random
+        centers = [(rnd.uniform(-50, 65), rnd.uniform(-180, 180), rnd.uniform(0.001, 0.5))
+                   for _ in xrange(clusters_n)]
+        cells = collections.defaultdict(list)
+        for photo_id in xrange(1, photos_n + 1):
+            if centers and rnd.random() < cluster_share:
+                lat, lon, sigma = rnd.choice(centers)
+                lat = clamp(rnd.gauss(lat, sigma), -89.999999, 89.999999)
+                lon = clamp(rnd.gauss(lon, sigma), -179.999999, 179.999999)
+            else:
+                lat = rnd.uniform(-60, 75)
+                lon = rnd.uniform(-180, 180)
+            lat = round(lat, 6)
+            lon = round(lon, 6)
+            photo = (rnd.randint(min_date, max_date), photo_id, lat, lon, rnd.randint(1, 16),
+                     '%d@N0%d' % (rnd.randint(1, photos_n // 10 + 1), rnd.randint(0, 9)))
+            cells[(int(math.floor(lat / cell_size)), int(math.floor(lon / cell_size)))].append(photo)
+        return cells
+
+    def search(self, min_lon, min_lat, max_lon, max_lat, min_date, max_date):
+        found = []
+        for cell_lat in xrange(int(math.floor(min_lat / cell_size)), int(math.floor(max_lat / cell_size)) + 1):
+            for cell_lon in xrange(int(math.floor(min_lon / cell_size)), int(math.floor(max_lon / cell_size)) + 1):
+                for photo in self.cells.get((cell_lat, cell_lon), ()):
+                    upload_date, _, lat, lon, _, _ = photo
+                    if (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon and
+                            min_date <= upload_date <= max_date):
+                        found.append(photo)
+        found.sort(reverse=True)
+        return found
+
+    def check_throttled(self):
+        if not self.throttle_rps:
+            return False
+        now = time.time()
+        with self.lock:
+            while self.recent_requests and self.recent_requests[0] < now - 1:
+                self.recent_requests.popleft()
+            self.recent_requests.append(now)
+            return len(self.recent_requests) > self.throttle_rps
+
+    # returns (http status, body)
+    def handle_request(self, params):
+        with self.lock:
+            self.requests_n += 1
+            fail = self.random.random() < self.error_rate
+            failure_kind = self.random.choice(['server', 'malformed', 'api'])
+            latency = self.latency * self.random.uniform(0.5, 1.5)
+        time.sleep(latency)
+        if self.check_throttled():
+            with self.lock:
+                self.throttled_n += 1
+            return 429, 'Too Many Requests'
+        if fail:
+            with self.lock:
+                self.errors_n += 1
+            if failure_kind == 'server':
+                return 502, 'Bad Gateway'
+            if failure_kind == 'malformed':
+                return 200, '{"photos": {"page": 1, '
+            return 200, json.dumps({'stat': 'fail', 'code': 105, 'message': 'Service currently unavailable'})
+        if params.get('method') != 'flickr.photos.search':
+            return 200, json.dumps({'stat': 'fail', 'code': 112, 'message': 'Method not found'})
+
+        min_lon, min_lat, max_lon, max_lat = map(float, params['bbox'].split(','))
+        photos = self.search(min_lon, min_lat, max_lon, max_lat,
+                             int(params.get('min_upload_date', 0)), int(params.get('max_upload_date', sys.maxint)))
+        per_page = clamp(int(params.get('per_page', 100)), 1, MAX_PER_PAGE)
+        page = max(1, int(params.get('page', 1)))
+        total = len(photos)
+        # like real API: only first MAX_RESULTS are accessible, pages after that repeat last available page
+        photos = photos[:MAX_RESULTS]
+        last_page = max(1, (len(photos) + per_page - 1) // per_page)
+        offset = (min(page, last_page) - 1) * per_page
+        page_photos = [{
+            'id': str(photo_id),
+            'owner': owner,
+            'latitude': lat,
+            'longitude': lon,
+            'accuracy': str(accuracy),
+            'dateupload': str(upload_date)}
+            for upload_date, photo_id, lat, lon, accuracy, owner in photos[offset:offset + per_page]]
+        return 200, json.dumps({
+            'stat': 'ok',
+            'photos': {
+                'page': page,
+                'pages': (total + per_page - 1) // per_page,
+                'perpage': per_page,
+                'total': str(total),
+                'photo': page_photos}})
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        params = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+        status, body = self.server.api.handle_request(params)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_server(api, host='127.0.0.1', port=0):
+    server = ThreadedHTTPServer((host, port), RequestHandler)
+    server.api = api
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def get_server_url(server):
+    host, port = server.server_address
+    return 'http://%s:%d/services/rest/' % (host, port)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--photos', type=int, default=100000)
+    parser.add_argument('--clusters', type=int, default=50)
+    parser.add_argument('--cluster-share', type=float, default=0.8)
+    parser.add_argument('--latency', type=float, default=0.05, help='mean response time, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.)
+    parser.add_argument('--throttle-rps', type=float, help='respond 429 above this requests rate')
+    parser.add_argument('--seed', type=int, default=0)
+    conf = parser.parse_args()
+    api = FakeFlickrApi(conf.photos, conf.clusters, conf.cluster_share, latency=conf.latency,
+                        error_rate=conf.error_rate, throttle_rps=conf.throttle_rps, seed=conf.seed)
+    server = start_server(api, conf.host, conf.port)
+    print 'Serving at', get_server_url(server)
+    try:
+        while True:
+            time.sleep(60)
+            print 'Requests:', api.requests_n, 'Errors:', api.errors_n, 'Throttled:', api.throttled_n
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# coding: utf-8
+# PNG of black image with given alpha channel, written directly with zlib. Image is stored as palette
+# with alpha of entry equal to its index, one byte per pixel instead of two in grayscale with alpha.
+# Rows are not filtered, for palette images filters make compression worse.
+import struct
+import zlib
+import numpy as np
+
+Z_RLE = 3
+
+_uniform_cache = {}
+
+
+def png_chunk(chunk_type, data):
+    return ''.join([struct.pack('>I', len(data)), chunk_type, data,
+                    struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)])
+
+
+def encode_alpha_png(alpha, level=6, strategy=zlib.Z_DEFAULT_STRATEGY):
+    # alpha is 2d uint8 array
+    max_alpha = int(alpha.max())
+    # tiles of single value (e.g. fully filled) are frequent
+    uniform = max_alpha == alpha.min()
+    if uniform:
+        key = (alpha.shape, max_alpha, level, strategy)
+        if key in _uniform_cache:
+            return _uniform_cache[key]
+    height, width = alpha.shape
+    rows = np.zeros((height, width + 1), dtype=np.uint8)
+    rows[:, 1:] = alpha
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9, strategy)
+    data = ''.join([
+        '\x89PNG\r\n\x1a\n',
+        png_chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)),
+        png_chunk('PLTE', '\0' * 3 * (max_alpha + 1)),
+        png_chunk('tRNS', np.arange(max_alpha + 1, dtype=np.uint8).tostring()),
+        png_chunk('IDAT', compressor.compress(rows.tostring()) + compressor.flush()),
+        png_chunk('IEND', '')
+    ])
+    if uniform:
+        _uniform_cache[key] = data
+    return data
+
+
+if __name__ == '__main__':
+    from cStringIO import StringIO
+    from PIL import Image
+    rnd = np.random.RandomState(0)
+    for alpha in [np.zeros((256, 256), dtype=np.uint8), np.full((256, 256), 255, dtype=np.uint8),
+                  rnd.randint(0, 256, (256, 256)).astype(np.uint8), rnd.randint(0, 3, (10, 20)).astype(np.uint8)]:
+        for level, strategy in [(6, zlib.Z_DEFAULT_STRATEGY), (1, Z_RLE)]:
+            im = Image.open(StringIO(encode_alpha_png(alpha, level, strategy))).convert('RGBA')
+            assert (np.array(im)[:, :, 3] == alpha).all() and not np.array(im)[:, :, :3].any()
+    print 'OK'
@@ -1,50 +1,202 @@
 # -*- coding: utf-8 -*-
 import os
+import hashlib
 import multiprocessing
+import threading
+import Queue
 import sqlite3
+from lib import split_chunks
 
 db_lock = multiprocessing.Lock()
 
 class MBTilesWriter(object):
+    # Identical tiles (e.g. fully filled) are stored once in images table, referenced by hash from map.
+    # Tiles are queued and written in batches by background thread, has_tile() and delete_descendants()
+    # do not see tiles written after last flush().
     SCHEME = '''
-        CREATE TABLE tiles(
-            zoom_level integer, tile_column integer, tile_row integer, tile_data blob,
-            UNIQUE(zoom_level, tile_column, tile_row) ON CONFLICT REPLACE);
+        CREATE TABLE map(zoom_level integer, tile_column integer, tile_row integer, tile_id text);
+
+        CREATE TABLE images(tile_data blob, tile_id text, UNIQUE(tile_id) ON CONFLICT IGNORE);
+
+        CREATE VIEW tiles AS
+            SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row,
+                images.tile_data AS tile_data
+            FROM map JOIN images ON images.tile_id = map.tile_id;
        
         CREATE TABLE metadata (name text, value text, UNIQUE(name) ON CONFLICT REPLACE);
     '''
+
+    # created on close, new db is filled faster without it
+    INDEXES = '''
+        CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row);
+    '''
     
     PRAGMAS = '''
+        PRAGMA page_size = 32768;
         PRAGMA journal_mode = off;
         PRAGMA synchronous = 0;
         PRAGMA busy_timeout = 10000;
     '''
 
+    batch_size = 1000
+    max_queued_tiles = 10000
+
     def __init__(self, path):
         need_init = not os.path.exists(path)
         self.path = path
+        self._existed = not need_init
+        # overwritten or deleted tiles of existing db can leave unreferenced images
+        self._clean_images = False
+        self._queue = Queue.Queue(self.max_queued_tiles)
+        self._thread = None
+        self._error = None
         if need_init:
             self.conn.executescript(self.SCHEME)
+        elif self._is_legacy():
+            self._upgrade()
+
+    def _is_legacy(self):
+        # tiles was a table with tile data before deduplication
+        row = self.conn.execute("SELECT type FROM sqlite_master WHERE name='tiles'").fetchone()
+        return row is not None and row[0] == 'table'
+
+    def _upgrade(self):
+        conn = self.conn
+        conn.execute('ALTER TABLE tiles RENAME TO tiles_old')
+        conn.executescript(self.SCHEME.replace('CREATE TABLE metadata', 'CREATE TABLE IF NOT EXISTS metadata'))
+        rows = conn.execute('SELECT tile_data, tile_column, tile_row, zoom_level FROM tiles_old')
+        for chunk in split_chunks(rows, self.batch_size):
+            self._insert_many(list(chunk))
+        conn.execute('DROP TABLE tiles_old')
+        conn.executescript(self.INDEXES)
+        conn.execute('VACUUM')
 
     _conn = None
 
     @property
     def conn(self):
         if self._conn is None:
-            conn = self._conn = sqlite3.connect(self.path)
+            # shared with writer thread, used under db_lock
+            conn = self._conn = sqlite3.connect(self.path, check_same_thread=False)
             conn.executescript(self.PRAGMAS)
         return self._conn
-    
+
+    def _insert_many(self, tiles):
+        # tiles are (data, tile_column, tile_row, zoom_level), rows are counted from bottom
+        images = []
+        rows = []
+        for data, tile_x, tile_y, level in tiles:
+            tile_id = hashlib.md5(data).hexdigest()
+            images.append((buffer(data), tile_id))
+            rows.append((level, tile_x, tile_y, tile_id))
+        with db_lock:
+            conn = self.conn
+            conn.executemany('INSERT INTO images (tile_data, tile_id) VALUES (?,?)', images)
+            conn.executemany('''
+                INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?,?,?,?)''', rows)
+
+    def _write_queued(self):
+        stop = False
+        while not stop:
+            tiles = [self._queue.get()]
+            while len(tiles) < self.batch_size and tiles[-1] is not None:
+                try:
+                    tiles.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = tiles[-1] is None
+            if stop:
+                tiles.pop()
+            try:
+                if self._error is None:
+                    self._insert_many(tiles)
+                    with db_lock:
+                        self.conn.commit()
+            except Exception as e:
+                self._error = e
+            for _ in xrange(len(tiles) + stop):
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise Exception('Writing tiles to %s failed: %s' % (self.path, self._error))
+
     def write(self, data, tile_x, tile_y, level):
+        self._check_error()
+        if self._thread is None:
+            # started on first write. Process should not fork while writer is open, child would inherit
+            # its connection and queue without thread.
+            self._thread = threading.Thread(target=self._write_queued)
+            self._thread.daemon = True
+            self._thread.start()
+        if self._existed:
+            self._clean_images = True
+        tile_y = 2 ** level - tile_y - 1
+        self._queue.put((data, tile_x, tile_y, level))
+
+    def flush(self):
+        # waits until queued tiles are written and committed
+        if self._thread is not None:
+            self._queue.join()
+        self._check_error()
+
+    def has_tile(self, tile_x, tile_y, level):
         tile_y = 2 ** level - tile_y - 1
-        s = buffer(data)
+        with db_lock:
+            return self.conn.execute('''
+                SELECT EXISTS (SELECT 1 FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?)''',
+                (level, tile_x, tile_y)).fetchone()[0]
+
+    def delete_descendants(self, tile_x, tile_y, level, max_level):
+        # tiles without children have no other descendants
+        if not any(self.has_tile(tile_x * 2 + dx, tile_y * 2 + dy, level + 1) for dx in (0, 1) for dy in (0, 1)):
+            return
+        self._clean_images = True
+        for child_level in xrange(level + 1, max_level + 1):
+            d = child_level - level
+            # rows are counted from bottom in mbtiles
+            min_row = 2 ** child_level - ((tile_y + 1) << d)
+            with db_lock:
+                self.conn.execute('''
+                    DELETE FROM map WHERE zoom_level=? AND tile_column >= ? AND tile_column < ?
+                    AND tile_row >= ? AND tile_row < ?''',
+                    (child_level, tile_x << d, (tile_x + 1) << d, min_row, min_row + (1 << d)))
+
+    def set_metadata(self, metadata):
+        # names with None value are deleted
+        with db_lock:
+            self.conn.executemany('DELETE FROM metadata WHERE name=?',
+                                  [(name,) for name, value in metadata.items() if value is None])
+            self.conn.executemany('INSERT INTO metadata (name, value) VALUES (?,?)',
+                                  [(name, value) for name, value in metadata.items() if value is not None])
+
+    def get_metadata(self):
+        with db_lock:
+            return dict(self.conn.execute('SELECT name, value FROM metadata'))
+
+    def merge(self, path):
+        # copies tiles from other mbtiles file, e.g. written by another process
+        self.flush()
         with db_lock:
             conn = self.conn
-            conn.execute('''
-                INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?,?,?,?)''',
-                (level, tile_x, tile_y, s))
+            conn.commit()
+            conn.execute('ATTACH DATABASE ? AS other', (path,))
+            conn.execute('INSERT INTO images SELECT tile_data, tile_id FROM other.images')
+            conn.execute('INSERT OR REPLACE INTO map SELECT zoom_level, tile_column, tile_row, tile_id FROM other.map')
+            conn.commit()
+            conn.execute('DETACH DATABASE other')
 
     def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+        self._check_error()
         conn = self.conn
+        conn.executescript(self.INDEXES)
+        if self._clean_images:
+            conn.execute('DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)')
+        min_zoom, max_zoom = conn.execute('SELECT min(zoom_level), max(zoom_level) FROM map').fetchone()
+        if min_zoom is not None:
+            self.set_metadata({'minzoom': str(min_zoom), 'maxzoom': str(max_zoom)})
         conn.commit()
         conn.close()
@@ -0,0 +1,30 @@
+# coding: utf-8
+# Spherical mercator (EPSG:3857) for numpy arrays, same as pyproj up to float rounding
+import numpy as np
+
+earth_radius = 6378137.0
+
+
+def lonlat_to_mercator(lon, lat):
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    return lon * earth_radius, np.log(np.tan(np.pi / 4 + lat / 2)) * earth_radius
+
+
+def mercator_to_lonlat(x, y):
+    x = np.asarray(x, dtype=np.float64) / earth_radius
+    y = np.asarray(y, dtype=np.float64) / earth_radius
+    return np.degrees(x), np.degrees(2 * np.arctan(np.exp(y)) - np.pi / 2)
+
+
+if __name__ == '__main__':
+    import pyproj
+    rnd = np.random.RandomState(0)
+    lon = rnd.uniform(-180, 180, 100000)
+    lat = rnd.uniform(-85.05, 85.05, 100000)
+    expected = pyproj.transform(pyproj.Proj('+init=EPSG:4326'), pyproj.Proj('+init=EPSG:3857'), lon, lat)
+    x, y = lonlat_to_mercator(lon, lat)
+    assert np.abs(x - expected[0]).max() < 1e-6 and np.abs(y - expected[1]).max() < 1e-6
+    lon2, lat2 = mercator_to_lonlat(x, y)
+    assert np.abs(lon2 - lon).max() < 1e-9 and np.abs(lat2 - lat).max() < 1e-9
+    print 'OK'
@@ -3,9 +3,16 @@ import struct
 import cPickle as pickle
 import time
 from collections import namedtuple
+import leveldb
 
 id_fmt = '<Q'
 
+# Rows are either pickled tuples (old format, starts with pickle protocol marker '\x80')
+# or version byte followed by fixed-width struct, owner is stored as id in owners table.
+ROW_V1 = '\x01'
+row_v1_struct = struct.Struct('<iiBIII')
+owner_id_fmt = '<I'
+
 
 Photo = namedtuple('Photo', 'lat_e7 lon_e7 accuracy fetch_ts upload_date owner')
 
@@ -22,12 +29,103 @@ def unpack_id(s):
     return struct.unpack(id_fmt, s)[0]
 
 
-def pack_row(photo):
+def pack_row(photo, owners):
     lat = int(round(photo['lat'] * 1e7))
     lon = int(round(photo['lon'] * 1e7))
-    data = (lat, lon, int(photo['accuracy']), int(time.time()), int(photo['upload_date']), photo['owner'])
-    return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+    owner_id = owners.get_id(photo['owner'])
+    return ROW_V1 + row_v1_struct.pack(lat, lon, int(photo['accuracy']), int(time.time()),
+                                       int(photo['upload_date']), owner_id)
 
 
-def unpack_row(s):
+def unpack_row(s, owners):
+    # owner of new rows is stored as id, it is resolved to owner string with OwnerTable
+    if s[0] == ROW_V1:
+        row = row_v1_struct.unpack_from(s, 1)
+        if owners is None:
+            raise Exception('Owners table is required to read rows with owner ids')
+        return Photo._make(row[:-1] + (owners.get_owner(row[-1]),))
     return Photo(*pickle.loads(s))
+
+
+def unpack_location(s):
+    # (lat_e7, lon_e7, upload_date) without resolving owner
+    if s[0] == ROW_V1:
+        lat_e7, lon_e7, _, _, upload_date, _ = row_v1_struct.unpack_from(s, 1)
+        return lat_e7, lon_e7, upload_date
+    photo = Photo(*pickle.loads(s))
+    return photo.lat_e7, photo.lon_e7, photo.upload_date
+
+
+def is_row_current(s):
+    return s[0] == ROW_V1
+
+
+def pack_photo(photo, owners):
+    # Photo tuple as returned by unpack_row
+    owner_id = owners.get_id(photo.owner)
+    return ROW_V1 + row_v1_struct.pack(*(photo[:-1] + (owner_id,)))
+
+
+def repack_row(s, owners):
+    if is_row_current(s):
+        return s
+    return pack_photo(unpack_row(s, owners), owners)
+
+
+def get_owners_db_filename(photo_db_filename):
+    return photo_db_filename.rstrip('/') + '_owners'
+
+
+class OwnerTable(object):
+    # Maps owner strings to integer ids, stored in separate leveldb next to photos db.
+    # New owners are kept in batch until flush(), it must be called before writing rows using them.
+    # Next id is cached, so there must be single writer: leveldb lets only one process open the db,
+    # and instance must not be shared by threads adding owners.
+
+    def __init__(self, path):
+        self.db = leveldb.LevelDB(path, max_open_files=100)
+        self._ids = {}
+        self._owners = {}
+        self._batch = leveldb.WriteBatch()
+        try:
+            self._next_id = struct.unpack(owner_id_fmt, self.db.Get('next_id'))[0]
+        except KeyError:
+            self._next_id = 1
+
+    def find_id(self, owner):
+        owner_id = self._ids.get(owner)
+        if owner_id is None:
+            try:
+                owner_id = struct.unpack(owner_id_fmt, self.db.Get('o' + owner))[0]
+            except KeyError:
+                return None
+            self._ids[owner] = owner_id
+        return owner_id
+
+    def get_id(self, owner):
+        owner_id = self.find_id(owner)
+        if owner_id is None:
+            owner_id = self._next_id
+            self._next_id += 1
+            packed_id = struct.pack(owner_id_fmt, owner_id)
+            self._batch.Put('o' + owner, packed_id)
+            self._batch.Put('i' + packed_id, owner)
+            self._batch.Put('next_id', struct.pack(owner_id_fmt, self._next_id))
+            self._ids[owner] = owner_id
+            self._owners[owner_id] = owner
+        return owner_id
+
+    def get_owner(self, owner_id):
+        owner = self._owners.get(owner_id)
+        if owner is None:
+            owner = self._owners[owner_id] = self.db.Get('i' + struct.pack(owner_id_fmt, owner_id))
+        return owner
+
+    def iterate(self):
+        # yields (owner_id, owner) for all owners
+        for k, v in self.db.RangeIter('i', 'j'):
+            yield struct.unpack(owner_id_fmt, k[1:])[0], v
+
+    def flush(self, sync=False):
+        self.db.Write(self._batch, sync=sync)
+        self._batch = leveldb.WriteBatch()
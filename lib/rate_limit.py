@@ -0,0 +1,101 @@
+# coding: utf-8
+import threading
+import time
+import random
+
+# (base, max) backoff delay in seconds for each kind of error
+backoff_delays = {
+    'throttled': (5, 120),
+    'server': (1, 60),
+    'timeout': (1, 30),
+    'connection': (1, 30),
+    'malformed': (1, 10),
+    'api': (1, 10),
+}
+default_backoff_delay = (1, 30)
+
+# errors that mean we are sending too much
+overload_errors = ('throttled', 'server', 'timeout')
+
+
+# Shared by all download threads.
+# acquire() blocks until a request can be sent, release() reports the outcome:
+# None for success or error kind (see backoff_delays).
+#  - token bucket limits requests per second (unlimited if requests_per_second is None)
+#  - concurrency limit is halved on overload and grows back by 1 per `concurrency` successes (AIMD)
+#  - after `breaker_threshold` consecutive failures all requests are stopped for `breaker_cooldown`
+#    seconds, then a single probe request is let through
+class RateLimiter(object):
+    def __init__(self, max_concurrency, requests_per_second=None,
+                 breaker_threshold=20, breaker_cooldown=30):
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.concurrency = float(max_concurrency)
+        self._cond = threading.Condition()
+        self._in_use = 0
+        self._tokens = 1.
+        self._tokens_ts = time.time()
+        self._last_decrease_ts = 0
+        self._consecutive_failures = 0
+        self._breaker_open_until = None
+        self._half_open = False
+
+    def _refill_tokens(self, now):
+        rate = self.requests_per_second
+        self._tokens = min(max(rate, 1), self._tokens + (now - self._tokens_ts) * rate)
+        self._tokens_ts = now
+
+    def _get_wait_time(self, now):
+        # returns None if we have to wait for other request to finish
+        if self._breaker_open_until is not None:
+            if now < self._breaker_open_until:
+                return self._breaker_open_until - now
+            self._breaker_open_until = None
+            self._half_open = True
+        if self._half_open and self._in_use:
+            return None
+        if self._in_use >= int(self.concurrency):
+            return None
+        if self.requests_per_second:
+            self._refill_tokens(now)
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.requests_per_second
+        return 0
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                wait_time = self._get_wait_time(time.time())
+                if wait_time == 0:
+                    break
+                self._cond.wait(wait_time)
+            self._in_use += 1
+            if self.requests_per_second:
+                self._tokens -= 1
+
+    def release(self, error=None):
+        with self._cond:
+            self._in_use -= 1
+            now = time.time()
+            if error is None:
+                self._consecutive_failures = 0
+                self._half_open = False
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1. / self.concurrency)
+            else:
+                self._consecutive_failures += 1
+                # decrease at most once a second, requests in flight fail together
+                if error in overload_errors and now - self._last_decrease_ts > 1:
+                    self.concurrency = max(1., self.concurrency / 2)
+                    self._last_decrease_ts = now
+                if self._half_open or self._consecutive_failures >= self.breaker_threshold:
+                    self._breaker_open_until = now + self.breaker_cooldown
+                    self._half_open = False
+                    self._consecutive_failures = 0
+            self._cond.notify_all()
+
+    def get_backoff_delay(self, error, attempt):
+        # exponential with full jitter, so failed threads do not retry all at once
+        base, max_delay = backoff_delays.get(error, default_backoff_delay)
+        return random.uniform(0, min(max_delay, base * 2 ** attempt))
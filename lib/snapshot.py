@@ -0,0 +1,94 @@
+# coding: utf-8
+# Columnar snapshot of photos db: one flat little-endian array file per column,
+# can be opened with numpy.memmap by batch stages instead of scanning leveldb.
+import os
+import sys
+import json
+import shutil
+import numpy as np
+import leveldb
+from lib import split_chunks
+from lib.photo_data import unpack_row, unpack_id, OwnerTable, get_owners_db_filename
+
+SNAPSHOT_VERSION = 2
+
+columns = [
+    ('photo_id', '<u8'),
+    ('lat_e7', '<i4'),
+    ('lon_e7', '<i4'),
+    ('upload_date', '<u4'),
+    ('owner_id', '<u4'),
+]
+
+
+def export_snapshot(photo_db_filename, snapshot_dir, chunk_size=1000000):
+    if not os.path.isdir(photo_db_filename):
+        raise Exception('%s not found' % photo_db_filename)
+    if os.path.exists(snapshot_dir):
+        shutil.rmtree(snapshot_dir)
+    os.makedirs(snapshot_dir)
+    src_db = leveldb.LevelDB(photo_db_filename, max_open_files=100)
+    owners = OwnerTable(get_owners_db_filename(photo_db_filename))
+    files = dict((name, open(os.path.join(snapshot_dir, name), 'wb')) for name, _ in columns)
+    count = 0
+    for chunk in split_chunks(src_db.RangeIter(fill_cache=False), chunk_size):
+        rows = []
+        for k, v in chunk:
+            photo = unpack_row(v, owners)
+            owner_id = owners.get_id(photo.owner)
+            rows.append((unpack_id(k), photo.lat_e7, photo.lon_e7, photo.upload_date, owner_id))
+        rows = np.array(rows, dtype=columns)
+        for name, _ in columns:
+            np.ascontiguousarray(rows[name]).tofile(files[name])
+        count += len(rows)
+        print '\r', count,
+        sys.stdout.flush()
+    owners.flush(sync=True)
+    for f in files.values():
+        f.close()
+    # owner table, readers of snapshot must not open owners db, it is locked by running downloader
+    with open(os.path.join(snapshot_dir, 'owners'), 'w') as f:
+        for owner_id, owner in owners.iterate():
+            f.write('%d %s\n' % (owner_id, owner))
+    # written last, snapshot without meta is incomplete
+    with open(os.path.join(snapshot_dir, 'meta.json'), 'w') as f:
+        json.dump({'version': SNAPSHOT_VERSION, 'count': count, 'columns': columns}, f)
+    return count
+
+
+def open_snapshot(snapshot_dir):
+    meta_filename = os.path.join(snapshot_dir, 'meta.json')
+    if not os.path.exists(meta_filename):
+        raise Exception('Snapshot %s not found or incomplete' % snapshot_dir)
+    with open(meta_filename) as f:
+        meta = json.load(f)
+    if meta['version'] != SNAPSHOT_VERSION:
+        raise Exception('Unsupported snapshot version %s' % meta['version'])
+    snapshot = {}
+    for name, dtype in columns:
+        if meta['count']:
+            snapshot[name] = np.memmap(os.path.join(snapshot_dir, name), dtype=dtype, mode='r',
+                                       shape=(meta['count'],))
+        else:
+            snapshot[name] = np.zeros(0, dtype=dtype)
+    return snapshot
+
+
+def find_owner_ids(snapshot_dir, owners):
+    # ids of owner strings in snapshot, owners without photos are skipped
+    owners = set(owners)
+    owner_ids = []
+    with open(os.path.join(snapshot_dir, 'owners')) as f:
+        for line in f:
+            owner_id, owner = line.rstrip('\n').split(' ', 1)
+            if owner in owners:
+                owner_ids.append(int(owner_id))
+    return owner_ids
+
+
+def iterate_rows(arrays, chunk_size=100000):
+    # converts columns to python tuples chunk by chunk
+    n = len(arrays[0])
+    for start in xrange(0, n, chunk_size):
+        for row in zip(*[a[start:start + chunk_size].tolist() for a in arrays]):
+            yield row
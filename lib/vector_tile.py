@@ -0,0 +1,109 @@
+# coding: utf-8
+# Tiles with points for client side drawing. Coordinates are integers in tile extent 2^extent_bits,
+# origin is in top left corner, points of tile margin can be outside of extent.
+# Format 1: 'VPTT', int32 tile x, y, z, then int32 x, y of points, extent is always 2^20.
+# Format 2: 'VPT2', then varints extent bits and number of points, followed by zigzag encoded
+# varint deltas of x, y of points sorted by morton code. Tile index is not stored, so tiles without
+# points are identical.
+import gzip
+from array import array
+from cStringIO import StringIO
+import numpy as np
+from lib.zorder import to_morton_2d_np
+
+full_extent_bits = 20
+
+
+def encode_varints(values):
+    # LEB128 of non-negative integers
+    rest = np.asarray(values, dtype=np.uint64)
+    groups = []
+    while True:
+        groups.append(rest & np.uint64(0x7f))
+        rest = rest >> np.uint64(7)
+        if not rest.any():
+            break
+    groups = np.column_stack(groups) if len(rest) else np.zeros((0, 1), dtype=np.uint64)
+    nonzero = groups != 0
+    n_bytes = np.maximum(groups.shape[1] - np.argmax(nonzero[:, ::-1], axis=1), 1)
+    n_bytes[~nonzero.any(axis=1)] = 1
+    positions = np.arange(groups.shape[1])
+    groups[positions < n_bytes[:, np.newaxis] - 1] |= np.uint64(0x80)
+    return groups[positions < n_bytes[:, np.newaxis]].astype(np.uint8).tostring()
+
+
+def decode_varints(data, count, offset=0):
+    # Returns (values, offset after last value)
+    if not count:
+        return np.zeros(0, dtype=np.uint64), offset
+    b = np.frombuffer(data, dtype=np.uint8, offset=offset)
+    ends = np.flatnonzero(b < 0x80)[:count]
+    if len(ends) < count:
+        raise Exception('Truncated varints')
+    b = b[:ends[-1] + 1]
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    positions = np.arange(len(b)) - np.repeat(starts, ends - starts + 1)
+    parts = (b & 0x7f).astype(np.uint64) << (positions * 7).astype(np.uint64)
+    return np.bitwise_or.reduceat(parts, starts), offset + len(b)
+
+
+def zigzag_encode(values):
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def zigzag_decode(values):
+    values = np.asarray(values, dtype=np.uint64)
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+def pack_points_v1(x, y, tile_x, tile_y, tile_z):
+    ar = array('i')
+    ar.extend([tile_x, tile_y, tile_z])
+    ar.extend(np.column_stack([x, y]).ravel().tolist())
+    return 'VPTT' + ar.tostring()
+
+
+def pack_points_v2(x, y, extent_bits):
+    # points quantized to the same coordinates are stored once
+    offset = 1 << extent_bits
+    codes = to_morton_2d_np(np.asarray(x, dtype=np.int64) + offset, np.asarray(y, dtype=np.int64) + offset)
+    _, indexes = np.unique(codes, return_index=True)
+    deltas = np.column_stack([np.diff(np.asarray(x, dtype=np.int64)[indexes], prepend=0),
+                              np.diff(np.asarray(y, dtype=np.int64)[indexes], prepend=0)]).ravel()
+    return ''.join(['VPT2', encode_varints([extent_bits, len(indexes)]),
+                    encode_varints(zigzag_encode(deltas))])
+
+
+def unpack_vector_tile(data):
+    # Returns (extent_bits, x, y) of tile in any format, possibly gzipped
+    data = str(data)
+    if data[:2] == '\x1f\x8b':
+        data = gzip.GzipFile(fileobj=StringIO(data)).read()
+    if data[:4] == 'VPTT':
+        ar = np.frombuffer(data, dtype='<i4', offset=4).astype(np.int64)
+        return full_extent_bits, ar[3::2], ar[4::2]
+    if data[:4] == 'VPT2':
+        header, offset = decode_varints(data, 2, 4)
+        extent_bits, count = header.tolist()
+        deltas, offset = decode_varints(data, count * 2, offset)
+        if offset != len(data):
+            raise Exception('Trailing data in vector tile')
+        coords = np.cumsum(zigzag_decode(deltas).reshape(-1, 2), axis=0)
+        return extent_bits, coords[:, 0], coords[:, 1]
+    raise Exception('Unknown vector tile format')
+
+
+if __name__ == '__main__':
+    values = [0, 1, 127, 128, 300, 16383, 16384, 2 ** 35 + 5, 2 ** 64 - 1]
+    assert decode_varints(encode_varints(values), len(values))[0].tolist() == values
+    assert zigzag_decode(zigzag_encode([0, -1, 1, -2 ** 40, 2 ** 40])).tolist() == [0, -1, 1, -2 ** 40, 2 ** 40]
+    rnd = np.random.RandomState(0)
+    for n in [0, 1, 2000]:
+        x = rnd.randint(-1000, (1 << 20) + 1000, n)
+        y = rnd.randint(-1000, (1 << 20) + 1000, n)
+        for data in [pack_points_v1(x, y, 5, 6, 7), pack_points_v2(x, y, 20)]:
+            unpacked = unpack_vector_tile(data)
+            assert unpacked[0] == 20
+            assert sorted(zip(unpacked[1].tolist(), unpacked[2].tolist())) == sorted(zip(x.tolist(), y.tolist()))
+    print 'OK'
@@ -1,4 +1,5 @@
 # coding: utf-8
+import numpy as np
 
 
 def to_morton_2d(x, y):
@@ -159,6 +160,39 @@ def to_morton_3d_approx(x, y, z):
     return answer
 
 
+def to_morton_2d_np(x, y):
+    # vectorized to_morton_2d for arrays of non-negative 32-bit integers
+    x = np.asarray(x, dtype=np.uint64)
+    y = np.asarray(y, dtype=np.uint64)
+    for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)]:
+        shift = np.uint64(shift)
+        mask = np.uint64(mask)
+        x = (x | (x << shift)) & mask
+        y = (y | (y << shift)) & mask
+    return x | (y << np.uint64(1))
+
+
+_morton256_x_np = np.array(morton256_x, dtype=np.uint64)
+_morton256_y_np = np.array(morton256_y, dtype=np.uint64)
+_morton256_z_np = np.array(morton256_z, dtype=np.uint64)
+
+
+def to_morton_3d_approx_np(x, y, z):
+    # vectorized to_morton_3d_approx
+    x = np.asarray(x, dtype=np.uint64) >> np.uint64(11)
+    y = np.asarray(y, dtype=np.uint64) >> np.uint64(11)
+    z = np.asarray(z, dtype=np.uint64) >> np.uint64(11)
+    answer = np.zeros(x.shape, dtype=np.uint64)
+    for shift in [16, 8, 0]:
+        shift = np.uint64(shift)
+        answer = (answer << np.uint64(24) |
+                  _morton256_z_np[(z >> shift) & np.uint64(0xFF)] |
+                  _morton256_y_np[(y >> shift) & np.uint64(0xFF)] |
+                  _morton256_x_np[(x >> shift) & np.uint64(0xFF)])
+    return answer
+
+
 if __name__ == '__main__':
     x = 10000000
     y = 200000000
@@ -5,32 +5,57 @@ from PIL import Image, ImageDraw
 from cStringIO import StringIO
 import os
 from lib.image_store import MBTilesWriter
-from lib.photo_data import unpack_row
+from lib.photo_data import unpack_row, OwnerTable, get_owners_db_filename
 from array import array
 import shutil
 import leveldb
 import time
 from lib import split_chunks
 import struct
-from lib.zorder import to_morton_2d
-import pyproj
+from lib.zorder import to_morton_2d_np
+from lib.snapshot import open_snapshot, iterate_rows, find_owner_ids
+from lib.vector_tile import pack_points_v1, pack_points_v2, full_extent_bits
+from lib.alpha_png import encode_alpha_png
+from lib.mercator import lonlat_to_mercator, mercator_to_lonlat
+import numpy as np
 import argparse
 import itertools
+import multiprocessing
 import gzip
+import zlib
+import tempfile
 
 symbol_radius = 5
 
 max_overviews_level = 5
 max_points_in_vector_tile = 2000
 max_points_in_normal_tile = 100000
+# Points of tile are kept in memory and passed down to its children if there are no more than this,
+# children of other tiles query the tree. Overview tiles fetch points only if this exceeds
+# max_points_in_normal_tile.
+max_points_passed_down = max_points_in_normal_tile
 max_level = 18
+# overview tiles have a symbol in every cell of grid with this step containing points
+overview_step_pixels = 2
+overview_margin_cells = (symbol_radius - 1) / overview_step_pixels + 2
+# point changes tile if it is closer to it than this, both for normal and overview tiles
+dirty_margin_pixels = max(symbol_radius, (overview_margin_cells + 1) * overview_step_pixels)
+# cells with points are precomputed up to this level, deeper overview tiles query the tree
+max_occupancy_level = 12
+# vector tiles format, see lib/vector_tile.py
+vector_tile_format = 1
+# format 2 tiles are quantized to quarter of pixel at this zoom, None for full precision
+vector_tile_max_zoom = None
+# zlib settings for raster tiles
+png_compress_level = 6
+png_compress_strategy = zlib.Z_DEFAULT_STRATEGY
+max_coord = 20037508.342789244
 
 banned_users = ['100597270@N04']
 
-proj_wgs84 = pyproj.Proj('+init=EPSG:4326')
-proj_gmerc = pyproj.Proj('+init=EPSG:3857')
 
 _symbol = None
+_paste_table = None
 
 
 assert len(array('i', [1]).tostring()) == 4
@@ -51,54 +76,135 @@ def get_symbol():
 
 
 def get_tile_extents(x, y, z):
-    max_coord = 20037508.342789244
     tile_size = 2 * max_coord / (1 << z)
     return (x * tile_size - max_coord, y * tile_size - max_coord, tile_size)
 
 
+def get_paste_table():
+    # Value of pixel after pasting 255 with mask alpha n times: table[n, value, alpha].
+    # Made with PIL, so rounding is the same as when pasting symbol for every point.
+    # Every paste raises pixel at least by 1 until it stops changing, so 255 pastes are enough.
+    global _paste_table
+    if _paste_table is None:
+        table = np.zeros((256, 256, 256), dtype=np.uint8)
+        im = Image.frombytes('L', (256, 256), np.repeat(np.arange(256, dtype=np.uint8), 256).tostring())
+        mask = Image.frombytes('L', (256, 256), np.tile(np.arange(256, dtype=np.uint8), 256).tostring())
+        for n in range(256):
+            table[n] = np.asarray(im)
+            im.paste(255, (0, 0, 256, 256), mask=mask)
+        _paste_table = table
+    return _paste_table
+
+
 def draw_raster_tile(points, tile_bounds):
-    im = Image.new('L', (256, 256), 0)
+    # Same image as pasting symbol for every point with PIL (up to order of pastes): points in one pixel
+    # are stamped once, every pixel of symbol is pasted count times at once with lookup table.
     tile_min_x, tile_min_y, tile_size = tile_bounds
-    marker = get_symbol()
     r = symbol_radius
     # points can be iterator, so we cannot check it's length
-    has_points = False
-    for x, y in points:
-        has_points = True
-        pix_x = (x - tile_min_x) / tile_size * 256
-        pix_y = (y - tile_min_y) / tile_size * 256
-        pix_y = 256 - pix_y
-        pix_x = int(pix_x)
-        pix_y = int(pix_y)
-        im.paste(255, (pix_x - r, pix_y - r, pix_x + r + 1, pix_y + r + 1), mask=marker)
-    if not has_points:
+    if not isinstance(points, np.ndarray):
+        points = list(points)
+    xy = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if not len(xy):
         return None
-    im2 = Image.new('LA', (256, 256), 0)
-    im2.putalpha(im)
-    fd = StringIO()
-    im2.save(fd, 'PNG')
-    return fd.getvalue()
+    # truncation towards zero as int() in pixel coordinates
+    pix_x = ((xy[:, 0] - tile_min_x) / tile_size * 256).astype(np.int64)
+    pix_y = (256 - (xy[:, 1] - tile_min_y) / tile_size * 256).astype(np.int64)
+    visible = (pix_x >= -r) & (pix_x < 256 + r) & (pix_y >= -r) & (pix_y < 256 + r)
+    # canvas has 2r pixels margin on each side, symbol top left corner is at pix + r
+    size = 256 + 4 * r
+    corners, counts = np.unique((pix_y[visible] + r) * size + pix_x[visible] + r, return_counts=True)
+    corner_y = corners // size
+    corner_x = corners % size
+    counts = np.minimum(counts, 255)
+    canvas = np.zeros((size, size), dtype=np.uint8)
+    symbol = np.asarray(get_symbol())
+    table = get_paste_table()
+    for dy, dx in zip(*np.nonzero(symbol)):
+        # corners are unique, so are targets for any single symbol pixel
+        target = corner_y + dy, corner_x + dx
+        canvas[target] = table[counts, canvas[target], symbol[dy, dx]]
+    data = np.ascontiguousarray(canvas[2 * r:2 * r + 256, 2 * r:2 * r + 256])
+    return encode_alpha_png(data, png_compress_level, png_compress_strategy)
+
+
+def get_overview_step(tile_z):
+    # grid cells of all tiles at one level are aligned, cell i covers (i * step, (i + 1) * step] from the world edge
+    return 2 * max_coord / (256 / overview_step_pixels << tile_z)
+
+
+def get_cells_indexes(x, y, tile_z):
+    step = get_overview_step(tile_z)
+    cells_x = np.ceil((np.asarray(x, dtype=np.float64) + max_coord) / step).astype(np.int64) - 1
+    cells_y = np.ceil((np.asarray(y, dtype=np.float64) + max_coord) / step).astype(np.int64) - 1
+    return cells_x, cells_y
+
+
+def get_cells_codes(cells_x, cells_y, tile_z):
+    return cells_y * (256 / overview_step_pixels << tile_z) + cells_x
+
+
+def get_overview_cells_range(tile_x, tile_y, tile_z):
+    # cells of tile with margin for symbols, clipped by world edges
+    cells_per_tile = 256 / overview_step_pixels
+    cells_per_world = cells_per_tile << tile_z
+    min_x = max(0, tile_x * cells_per_tile - overview_margin_cells)
+    max_x = min(cells_per_world, (tile_x + 1) * cells_per_tile + overview_margin_cells - 1)
+    min_y = max(0, tile_y * cells_per_tile - overview_margin_cells)
+    max_y = min(cells_per_world, (tile_y + 1) * cells_per_tile + overview_margin_cells - 1)
+    return min_x, max_x, min_y, max_y
 
 
-def draw_overview_tile(db, tile_x, tile_y, tile_z):
-    step_pixels = 2
-    tile_bounds = tile_min_x, tile_min_y, tile_size = get_tile_extents(tile_x, tile_y, tile_z)
-    points = []
-    pixel_meters = tile_size / 256
-    step_meters = step_pixels * pixel_meters
-    margin_steps = (symbol_radius - 1) / step_pixels + 2
-    margin_pixels = margin_steps * step_pixels
-    for x in xrange(-margin_pixels, 256 + margin_pixels - step_pixels, step_pixels):
-        min_x = tile_min_x + x * pixel_meters
-        max_x = min_x + step_meters
-        for y in xrange(-margin_pixels, 256 + margin_pixels - step_pixels, step_pixels):
-            min_y = tile_min_y + y * pixel_meters
-            max_y = min_y + step_meters
-            if db.execute(
-                    'SELECT EXISTS (SELECT 1 FROM point WHERE minx > ? AND minx <= ? AND miny > ? AND miny <= ? LIMIT 1)',
-                    (min_x, max_x, min_y, max_y)).fetchall()[0][0]:
-                points.append((min_x + step_pixels / 2, min_y + step_pixels / 2))
-    if points:
+def build_occupancy(codes_chunks):
+    # Returns list of sorted arrays of codes of cells with points for levels up to max_occupancy_level,
+    # codes_chunks are arrays of codes at max_occupancy_level.
+    codes = np.unique(np.concatenate(codes_chunks)) if codes_chunks else np.zeros(0, dtype=np.int64)
+    levels = [codes]
+    for tile_z in xrange(max_occupancy_level, 0, -1):
+        cells_per_world = 256 / overview_step_pixels << tile_z
+        codes = get_cells_codes(codes % cells_per_world >> 1, codes // cells_per_world >> 1, tile_z - 1)
+        levels.append(np.unique(codes))
+    levels.reverse()
+    return levels
+
+
+def save_occupancy(occupancy, filename):
+    with open(filename, 'wb') as f:
+        np.savez(f, *occupancy)
+
+
+def load_occupancy(filename):
+    data = np.load(filename)
+    return [data['arr_%d' % i] for i in xrange(len(data.files))]
+
+
+def get_overview_cells(db, occupancy, tile_x, tile_y, tile_z):
+    # returns x and y indexes of cells of tile (with margin) containing points
+    min_x, max_x, min_y, max_y = get_overview_cells_range(tile_x, tile_y, tile_z)
+    if occupancy is not None and tile_z < len(occupancy):
+        codes = occupancy[tile_z]
+        rows = np.arange(min_y, max_y, dtype=np.int64)
+        starts = np.searchsorted(codes, get_cells_codes(min_x, rows, tile_z))
+        ends = np.searchsorted(codes, get_cells_codes(max_x, rows, tile_z))
+        codes = np.concatenate([codes[start:end] for start, end in zip(starts, ends)])
+    else:
+        step = get_overview_step(tile_z)
+        points = db.execute('SELECT minx, miny FROM point WHERE minx > ? AND minx <= ? AND miny > ? AND miny <= ?',
+                            (min_x * step - max_coord, max_x * step - max_coord,
+                             min_y * step - max_coord, max_y * step - max_coord)).fetchall()
+        x, y = np.array(points, dtype=np.float64).reshape(-1, 2).T
+        codes = np.unique(get_cells_codes(*get_cells_indexes(x, y, tile_z) + (tile_z,)))
+    cells_per_world = 256 / overview_step_pixels << tile_z
+    return codes % cells_per_world, codes // cells_per_world
+
+
+def draw_overview_tile(db, tile_x, tile_y, tile_z, occupancy=None):
+    tile_bounds = get_tile_extents(tile_x, tile_y, tile_z)
+    cells_x, cells_y = get_overview_cells(db, occupancy, tile_x, tile_y, tile_z)
+    if len(cells_x):
+        # symbol is drawn near lower left cell corner
+        step = get_overview_step(tile_z)
+        points = np.column_stack([cells_x * step - max_coord + 1, cells_y * step - max_coord + 1])
         image_data = draw_raster_tile(points, tile_bounds)
         return {'data': image_data, 'is_vector': False}
     else:
@@ -124,22 +230,38 @@ def get_points_for_tile(db, tile_x, tile_y, tile_z):
     return points
 
 
-def draw_normal_tile(db, tile_x, tile_y, tile_z):
-    points_iterator = get_points_for_tile(db, tile_x, tile_y, tile_z)
-    points1 = list(itertools.islice(points_iterator, 0, max_points_in_normal_tile + 1))
-    if len(points1) <= max_points_in_vector_tile:
-        image_data = make_vector_tile(points1, tile_x, tile_y, tile_z)
+def select_points_for_tile(points, tile_x, tile_y, tile_z):
+    # same condition as in get_points_for_tile()
+    (min_x, max_x, min_y, max_y) = tile_with_margin_extents(tile_x, tile_y, tile_z)
+    x = points[:, 0]
+    y = points[:, 1]
+    return points[(x > min_x) & (x <= max_x) & (y > min_y) & (y <= max_y)]
+
+
+def draw_normal_tile(db, tile_x, tile_y, tile_z, occupancy=None, points=None):
+    # points are array of all points of tile with margin if known, e.g. selected from points of parent tile.
+    # Points are returned with result if there are no more than max_points_passed_down.
+    if points is None:
+        points_iterator = get_points_for_tile(db, tile_x, tile_y, tile_z)
+        points = list(itertools.islice(points_iterator, 0,
+                                       max(max_points_in_normal_tile, max_points_passed_down) + 1))
+        points = np.array(points, dtype=np.int64).reshape(-1, 2)
+    if len(points) <= max_points_in_vector_tile:
+        image_data = make_vector_tile(points.tolist(), tile_x, tile_y, tile_z)
         if len(image_data) > 500:
             compressed = gzip_compress(image_data)
             if len(compressed) < len(image_data):
                 image_data = compressed
         return {'data': image_data, 'is_vector': True}
-    elif len(points1) > max_points_in_normal_tile:
-        return draw_overview_tile(db, tile_x, tile_y, tile_z)
+    elif len(points) > max_points_in_normal_tile:
+        res = draw_overview_tile(db, tile_x, tile_y, tile_z, occupancy)
     else:
         tile_bounds = get_tile_extents(tile_x, tile_y, tile_z)
-        image_data = draw_raster_tile(itertools.chain(points1, points_iterator), tile_bounds)
-        return {'data': image_data, 'is_vector': False}
+        image_data = draw_raster_tile(points, tile_bounds)
+        res = {'data': image_data, 'is_vector': False}
+    if len(points) <= max_points_passed_down:
+        res['points'] = points
+    return res
 
 
 def gzip_compress(s):
@@ -150,18 +272,28 @@ def gzip_compress(s):
     return f.getvalue()
 
 
+def get_vector_tile_extent_bits(tile_z):
+    if vector_tile_max_zoom is None:
+        return full_extent_bits
+    # tile has 2^8 pixels at its own zoom, vector tiles are shown scaled at deeper zooms
+    return max(10, min(full_extent_bits, 10 + vector_tile_max_zoom - tile_z))
+
+
 def make_vector_tile(points, tile_x, tile_y, tile_z):
-    extent = 1 << 20
     tile_min_x, tile_min_y, tile_size = get_tile_extents(tile_x, tile_y, tile_z)
-    ar = array('i')
-    ar.extend([tile_x, tile_y, tile_z])
+    if vector_tile_format == 2:
+        extent_bits = get_vector_tile_extent_bits(tile_z)
+        points = np.array(points, dtype=np.float64).reshape(-1, 2)
+        x = np.round((points[:, 0] - tile_min_x) / tile_size * (1 << extent_bits))
+        y = np.round((1 - (points[:, 1] - tile_min_y) / tile_size) * (1 << extent_bits))
+        return pack_points_v2(x, y, extent_bits)
+    extent = 1 << full_extent_bits
+    xs = []
+    ys = []
     for x, y in points:
-        x = (x - tile_min_x) / tile_size * extent
-        y = (1 - (y - tile_min_y) / tile_size) * extent
-        ar.append(int(round(x)))
-        ar.append(int(round(y)))
-    data = 'VPTT' + ar.tostring()
-    return data
+        xs.append(int(round((x - tile_min_x) / tile_size * extent)))
+        ys.append(int(round((1 - (y - tile_min_y) / tile_size) * extent)))
+    return pack_points_v1(xs, ys, tile_x, tile_y, tile_z)
 
 
 def tile_index_from_tms((x, y, z)):
@@ -169,33 +301,233 @@ def tile_index_from_tms((x, y, z)):
     return x, y, z
 
 
-def make_tiles(tree, tiles_db_filename):
-    if os.path.exists(tiles_db_filename):
-        os.remove(tiles_db_filename)
-    writer = MBTilesWriter(tiles_db_filename)
-    queue = [(0, 0, 0)]
+def render_tiles(tree, writer, root_tile, stop_level=None, show_progress=False, occupancy=None):
+    # Renders tile and its descendants depth-first. Returns number of rendered tiles
+    # and tiles at stop_level, which are not rendered.
+    # parent points are selected for tile when it is taken from queue, so siblings share one array
+    queue = [root_tile + (None,)]
+    postponed = []
     n = 0
 
     while queue:
-        tile = queue.pop()
-        x, y, z = tile[:3]
-        res = draw_normal_tile(tree, *tile)
+        x, y, z, parent_points = queue.pop()
+        if z == stop_level:
+            postponed.append((x, y, z))
+            continue
+        points = None
+        if parent_points is not None:
+            points = select_points_for_tile(parent_points, x, y, z)
+        res = draw_normal_tile(tree, x, y, z, occupancy, points)
         assert res['data']
         if res['data']:
-            writer.write(res['data'], *tile_index_from_tms(tile[:3]))
+            writer.write(res['data'], *tile_index_from_tms((x, y, z)))
             if (not res['is_vector']) and z <= max_level:
-                queue.append((x * 2, y * 2, z + 1))
-                queue.append((x * 2 + 1, y * 2, z + 1))
-                queue.append((x * 2, y * 2 + 1, z + 1))
-                queue.append((x * 2 + 1, y * 2 + 1, z + 1))
+                points = res.get('points')
+                queue.append((x * 2, y * 2, z + 1, points))
+                queue.append((x * 2 + 1, y * 2, z + 1, points))
+                queue.append((x * 2, y * 2 + 1, z + 1, points))
+                queue.append((x * 2 + 1, y * 2 + 1, z + 1, points))
             n += 1
-            print '\r', n,
-            sys.stdout.flush()
+            if show_progress:
+                print '\r', n,
+                sys.stdout.flush()
+    return n, postponed
+
+
+# opened in each worker process
+_worker_tree = None
+_worker_writer = None
+_worker_occupancy = None
+# existing tiles db, read by workers updating it
+_worker_tiles = None
+_worker_dirty = None
+
+
+def _init_tiles_worker(tree_filename, shards_dir, occupancy):
+    global _worker_tree, _worker_writer, _worker_occupancy
+    _worker_occupancy = occupancy
+    _worker_tree = sqlite3.connect(tree_filename)
+    _worker_tree.execute('PRAGMA query_only = 1')
+    _worker_writer = MBTilesWriter(os.path.join(shards_dir, 'tiles_%d.mbtiles' % os.getpid()))
+
+
+def _render_subtree(tile):
+    n, _ = render_tiles(_worker_tree, _worker_writer, tile, occupancy=_worker_occupancy)
+    # worker processes are not closed gracefully, so every subtree is committed
+    _worker_writer.flush()
+    return n
+
+
+def _init_update_worker(tree_filename, shards_dir, tiles_db_filename, dirty, occupancy):
+    global _worker_tiles, _worker_dirty
+    _init_tiles_worker(tree_filename, shards_dir, occupancy)
+    _worker_tiles = MBTilesWriter(tiles_db_filename)
+    _worker_dirty = dirty
+
+
+def _update_subtree(tile):
+    n, _, vector_tiles = update_subtree(_worker_tree, _worker_writer, _worker_tiles, tile, _worker_dirty,
+                                        occupancy=_worker_occupancy)
+    _worker_writer.flush()
+    return n, vector_tiles
+
+
+def make_shards_dir(temp_dir):
+    shards_dir = os.path.join(temp_dir, 'tiles_shards_tmp')
+    if os.path.exists(shards_dir):
+        shutil.rmtree(shards_dir)
+    os.makedirs(shards_dir)
+    return shards_dir
+
+
+def merge_shards(writer, shards_dir):
+    for shard_filename in sorted(os.listdir(shards_dir)):
+        writer.merge(os.path.join(shards_dir, shard_filename))
+    shutil.rmtree(shards_dir)
+
+
+def make_tiles(tree, tiles_db_filename, processes=1, temp_dir=None, split_level=6, occupancy=None):
+    # With several processes tiles above split_level are rendered here and subtrees of tiles
+    # at split_level by worker processes, each writes its own mbtiles shard merged at the end.
+    if os.path.exists(tiles_db_filename):
+        os.remove(tiles_db_filename)
+    if processes > 1:
+        tree_filename = tree.execute('PRAGMA database_list').fetchone()[2]
+        shards_dir = make_shards_dir(temp_dir)
+        # started before writer, so workers do not inherit its connection and queue without thread,
+        # occupancy is inherited by fork, not pickled
+        pool = multiprocessing.Pool(processes, _init_tiles_worker, (tree_filename, shards_dir, occupancy))
+    writer = MBTilesWriter(tiles_db_filename)
+    if processes == 1:
+        render_tiles(tree, writer, (0, 0, 0), show_progress=True, occupancy=occupancy)
+        writer.close()
+        return
+
+    n, subtrees = render_tiles(tree, writer, (0, 0, 0), stop_level=split_level, occupancy=occupancy)
+    writer.flush()
+    for subtree_n in pool.imap_unordered(_render_subtree, subtrees):
+        n += subtree_n
+        print '\r', n,
+        sys.stdout.flush()
+    pool.close()
+    pool.join()
+    merge_shards(writer, shards_dir)
     writer.close()
 
 
-def get_banned_owners():
-    return banned_users
+def get_dirty_tiles(keys):
+    # Returns list of sorted arrays of codes (x << z | y) of tiles affected by points with given keys,
+    # one array per level
+    x, y = get_points_from_keys(keys)
+    dirty = []
+    for tile_z in xrange(max_level + 2):
+        tile_size = 2 * max_coord / (1 << tile_z)
+        margin = dirty_margin_pixels * tile_size / 256
+        tiles_x = [np.clip(((x + d + max_coord) // tile_size).astype(np.int64), 0, (1 << tile_z) - 1)
+                   for d in (-margin, margin)]
+        tiles_y = [np.clip(((y + d + max_coord) // tile_size).astype(np.int64), 0, (1 << tile_z) - 1)
+                   for d in (-margin, margin)]
+        dirty.append(np.unique(np.concatenate([tile_x << tile_z | tile_y for tile_x in tiles_x for tile_y in tiles_y])))
+    return dirty
+
+
+def check_tile_dirty(dirty, x, y, z):
+    codes = dirty[z]
+    code = x << z | y
+    i = np.searchsorted(codes, code)
+    return i < len(codes) and codes[i] == code
+
+
+def update_subtree(tree, writer, tiles, root_tile, dirty, stop_level=None, show_progress=False, occupancy=None):
+    # Renders again dirty tiles of subtree of existing mbtiles `tiles`, tiles are written by writer,
+    # which can be the same or a shard. Dirty tiles of a level are inside dirty tiles of the level above,
+    # so subtrees of clean tiles are skipped, unless tile did not exist (its parent was vector tile before).
+    # Returns number of rendered tiles, tiles at stop_level to update and tiles which became vector,
+    # their descendants are to be deleted.
+    queue = [root_tile + (None,)]
+    postponed = []
+    vector_tiles = []
+    n = 0
+    while queue:
+        x, y, z, parent_points = queue.pop()
+        if not check_tile_dirty(dirty, x, y, z) and tiles.has_tile(*tile_index_from_tms((x, y, z))):
+            continue
+        if z == stop_level:
+            postponed.append((x, y, z))
+            continue
+        points = None
+        if parent_points is not None:
+            points = select_points_for_tile(parent_points, x, y, z)
+        res = draw_normal_tile(tree, x, y, z, occupancy, points)
+        writer.write(res['data'], *tile_index_from_tms((x, y, z)))
+        if (not res['is_vector']) and z <= max_level:
+            points = res.get('points')
+            queue.append((x * 2, y * 2, z + 1, points))
+            queue.append((x * 2 + 1, y * 2, z + 1, points))
+            queue.append((x * 2, y * 2 + 1, z + 1, points))
+            queue.append((x * 2 + 1, y * 2 + 1, z + 1, points))
+        else:
+            vector_tiles.append((x, y, z))
+        n += 1
+        if show_progress:
+            print '\r', n,
+            sys.stdout.flush()
+    return n, postponed, vector_tiles
+
+
+def update_tiles(tree, tiles_db_filename, dirty, processes=1, temp_dir=None, split_level=6, occupancy=None):
+    # Tiles above split_level are updated here, with several processes dirty subtrees of tiles at split_level
+    # are rendered by workers to shards as in make_tiles(). Workers only read existing tiles db.
+    if processes > 1:
+        # legacy db is upgraded before workers open it
+        MBTilesWriter(tiles_db_filename).close()
+        tree_filename = tree.execute('PRAGMA database_list').fetchone()[2]
+        shards_dir = make_shards_dir(temp_dir)
+        # started before writer, dirty tiles and occupancy are inherited by fork
+        pool = multiprocessing.Pool(processes, _init_update_worker,
+                                    (tree_filename, shards_dir, tiles_db_filename, dirty, occupancy))
+    writer = MBTilesWriter(tiles_db_filename)
+    if processes == 1:
+        n, _, vector_tiles = update_subtree(tree, writer, writer, (0, 0, 0), dirty, show_progress=True,
+                                            occupancy=occupancy)
+    else:
+        n, subtrees, vector_tiles = update_subtree(tree, writer, writer, (0, 0, 0), dirty, split_level,
+                                                   occupancy=occupancy)
+        writer.flush()
+        for subtree_n, subtree_vector_tiles in pool.imap_unordered(_update_subtree, subtrees):
+            n += subtree_n
+            vector_tiles.extend(subtree_vector_tiles)
+            print '\r', n,
+            sys.stdout.flush()
+        pool.close()
+        pool.join()
+        merge_shards(writer, shards_dir)
+    for tile in vector_tiles:
+        writer.delete_descendants(*tile_index_from_tms(tile) + (max_level + 1,))
+    writer.close()
+    return n
+
+
+def get_tiles_metadata(occupancy):
+    metadata = {
+        'name': 'Flickr photos',
+        'type': 'overlay',
+        # Tiles are png or vector tiles (not in mapbox format, see lib/vector_tile.py), there is
+        # no format value for such mix, so it is not set.
+        'format': None,
+        'vector_format': str(vector_tile_format),
+    }
+    codes = occupancy[max_occupancy_level]
+    if len(codes):
+        cells_per_world = 256 / overview_step_pixels << max_occupancy_level
+        step = get_overview_step(max_occupancy_level)
+        cells_x = codes % cells_per_world
+        # codes are sorted by row first
+        x = [cells_x.min() * step - max_coord, (cells_x.max() + 1) * step - max_coord]
+        y = [codes[0] // cells_per_world * step - max_coord, (codes[-1] // cells_per_world + 1) * step - max_coord]
+        lons, lats = mercator_to_lonlat(x, y)
+        metadata['bounds'] = '%.6f,%.6f,%.6f,%.6f' % (lons[0], lats[0], lons[1], lats[1])
+    return metadata
 
 
 def iterate_src_points(src_db_filename):
@@ -203,9 +535,12 @@ def iterate_src_points(src_db_filename):
         raise Exception()
 
     src_db = leveldb.LevelDB(src_db_filename, max_open_files=100)
-    banned_owners = get_banned_owners()
+    owners_db_filename = get_owners_db_filename(src_db_filename)
+    # db with only old rows has no owners table
+    owners = OwnerTable(owners_db_filename) if os.path.exists(owners_db_filename) else None
+    banned_owners = set(banned_users)
     for i, (_, v) in enumerate(src_db.RangeIter(fill_cache=False)):
-        photo = unpack_row(v)
+        photo = unpack_row(v, owners)
         if photo.owner in banned_owners:
             continue
         lat = photo.lat_e7
@@ -213,15 +548,32 @@ def iterate_src_points(src_db_filename):
         yield lat, lon
 
 
+def get_valid_points_mask(lat_e7, lon_e7):
+    # points out of mercator bounds and with zero or swapped coordinates are skipped
+    return (lat_e7 > -850511300) & (lat_e7 < 850511300) & (lat_e7 != 0) & (lon_e7 != 0) & (lat_e7 != lon_e7)
+
+
+def project_points(lat_e7, lon_e7):
+    # returns integer mercator coordinates
+    x, y = lonlat_to_mercator(lon_e7 / 1e7, lat_e7 / 1e7)
+    return np.rint(x).astype(np.int64), np.rint(y).astype(np.int64)
+
+
 def store_chunk_sorted_db(db, points):
     batch = leveldb.WriteBatch()
-    for z, lat, lon in points:
+    for z, x, y in points:
         k = struct.pack('>Q', z)
-        v = struct.pack('<ii', lat, lon)
+        v = struct.pack('<ii', x, y)
         batch.Put(k, v)
     db.Write(batch)
 
 
+def merge_sorted_runs((codes1, counts1), (codes2, counts2)):
+    # runs have no codes in common, merged in linear time
+    positions = np.searchsorted(codes1, codes2)
+    return np.insert(codes1, positions, codes2), np.insert(counts1, positions, counts2)
+
+
 def build_sorted_points_db(photo_db, temp_dir):
     sorted_db_filename = os.path.join(temp_dir, 'flickr_sorted_2d_tmp')
 
@@ -233,38 +585,109 @@ def build_sorted_points_db(photo_db, temp_dir):
         shutil.rmtree(sorted_db_filename)
     db = leveldb.LevelDB(sorted_db_filename, max_open_files=100)
     chunk_size = 100000
+    # sorted runs of codes of stored points with numbers of points at them, points with seen codes are not written again
+    seen = []
+    points_n = 0
     for i, points in enumerate(split_chunks(iterate_src_points(photo_db), chunk_size)):
-        points = set(points)
-        points = [(to_morton_2d(lon + 1800000000, lat + 1800000000), lat, lon)
-                  for lat, lon in points]
-        store_chunk_sorted_db(db, points)
+        lat, lon = np.array(list(points), dtype=np.int64).reshape(-1, 2).T
+        mask = get_valid_points_mask(lat, lon)
+        lat = lat[mask]
+        lon = lon[mask]
+        points_n += len(lat)
+        # points are sorted by geographic coordinates, but stored projected
+        z, indexes, counts = np.unique(to_morton_2d_np(lon + 1800000000, lat + 1800000000),
+                                       return_index=True, return_counts=True)
+        counts = counts.astype(np.uint32)
+        is_new = np.ones(len(z), dtype=bool)
+        for seen_codes, seen_counts in seen:
+            positions = np.minimum(np.searchsorted(seen_codes, z), len(seen_codes) - 1)
+            found = seen_codes[positions] == z
+            seen_counts[positions[found]] += counts[found]
+            is_new &= ~found
+        z = z[is_new]
+        indexes = indexes[is_new]
+        x, y = project_points(lat[indexes], lon[indexes])
+        store_chunk_sorted_db(db, itertools.izip(z.tolist(), x.tolist(), y.tolist()))
+        if len(z):
+            seen.append((z, counts[is_new]))
+        # runs are merged as in binary counter, so there are O(log n) of them and every code is moved O(log n) times
+        while len(seen) > 1 and len(seen[-2][0]) <= 2 * len(seen[-1][0]):
+            seen[-2:] = [merge_sorted_runs(seen[-2], seen[-1])]
 
         print '\r', i * chunk_size,
         sys.stdout.flush()
 
+    print
+    print_duplicates_stats(points_n, np.concatenate([counts for _, counts in seen] + [np.zeros(0, dtype=np.uint32)]))
     return db
 
 
+def print_duplicates_stats(points_n, counts):
+    # counts are numbers of points with the same coordinates
+    print 'Points: %d, unique: %d, duplicates: %d' % (points_n, len(counts), points_n - len(counts))
+    if len(counts):
+        print 'Coordinates with duplicates: %d, most points at same coordinates: %d' % (
+            np.count_nonzero(counts > 1), counts.max())
+
+
 def iterate_sorted_points(db):
+    # yields mercator x, y
     for _, v in db.RangeIter(fill_cache=False):
-        lat, lon = struct.unpack('<ii', v)
-        lat /= 1e7
-        lon /= 1e7
-        if (-85.05113 < lat < 85.05113) and lat != 0 and lon != 0 and lat != lon:
-            yield lat, lon
-
-
-def store_chunk_to_tree(tree, latlons):
-    lats, lons = zip(*latlons)
-    x, y = pyproj.transform(proj_wgs84, proj_gmerc, lons, lats)
-    x = (int(round(c)) for c in x)
-    y = (int(round(c)) for c in y)
-    xy = zip(x, y)
-    params = (((x2 << 32) | y2, x2, x2, y2, y2) for (x2, y2) in xy)
+        yield struct.unpack('<ii', v)
+
+
+def iterate_snapshot_sorted_points(snapshot_dir):
+    # same points and order as iterate_sorted_points(build_sorted_points_db(...))
+    snapshot = open_snapshot(snapshot_dir)
+    banned_ids = find_owner_ids(snapshot_dir, banned_users)
+    not_banned = ~np.in1d(snapshot['owner_id'], np.array(banned_ids, dtype=np.uint32))
+    lat = snapshot['lat_e7'][not_banned]
+    lon = snapshot['lon_e7'][not_banned]
+    z = to_morton_2d_np(lon.astype(np.int64) + 1800000000, lat.astype(np.int64) + 1800000000)
+    _, uniq_indexes, counts = np.unique(z, return_index=True, return_counts=True)
+    del z
+    lat = lat[uniq_indexes]
+    lon = lon[uniq_indexes]
+    mask = get_valid_points_mask(lat, lon)
+    print_duplicates_stats(counts[mask].sum(), counts[mask])
+    return iterate_rows(project_points(lat[mask], lon[mask]))
+
+
+def store_chunk_to_tree(tree, points):
+    x, y = zip(*points)
+    # y is offset to unsigned 32 bits, otherwise negative y overwrites high bits and ids collide
+    params = (((x2 << 32) | (y2 + (1 << 31)), x2, x2, y2, y2) for (x2, y2) in zip(x, y))
     tree.executemany('INSERT OR IGNORE INTO point VALUES (?,?,?,?,?)', params)
+    return x, y
+
+
+def get_points_keys(x, y):
+    # unique keys of points with integer mercator coordinates
+    x = (np.asarray(x, dtype=np.int64) + (1 << 31)).astype(np.uint64)
+    y = (np.asarray(y, dtype=np.int64) + (1 << 31)).astype(np.uint64)
+    return x << np.uint64(32) | y
+
+
+def get_points_from_keys(keys):
+    x = (keys >> np.uint64(32)).astype(np.int64) - (1 << 31)
+    y = (keys & np.uint64(0xFFFFFFFF)).astype(np.int64) - (1 << 31)
+    return x, y
 
 
-def build_tree(sorted_db, temp_dir):
+def get_points_filename(temp_dir):
+    return os.path.join(temp_dir, 'flickr_points_2d_tmp.npy')
+
+
+def get_tiles_points_filename(tiles_db_filename):
+    # keys of points tiles were made from, to find changed tiles on next update
+    return tiles_db_filename + '.points.npy'
+
+
+def get_occupancy_filename(temp_dir):
+    return os.path.join(temp_dir, 'flickr_occupancy_2d_tmp.npz')
+
+
+def build_tree(points, temp_dir):
     tree_filename = os.path.join(temp_dir, 'flickr_tree_2d_tmp')
 
     # for experiments:
@@ -287,45 +710,157 @@ def build_tree(sorted_db, temp_dir):
     ''')
 
     chunk_size = 10000
-    for i, chunk in enumerate(split_chunks(iterate_sorted_points(sorted_db), chunk_size)):
-        store_chunk_to_tree(tree, chunk)
+    codes_chunks = []
+    keys_chunks = []
+    for i, chunk in enumerate(split_chunks(points, chunk_size)):
+        x, y = store_chunk_to_tree(tree, chunk)
+        codes_chunks.append(np.unique(get_cells_codes(*get_cells_indexes(x, y, max_occupancy_level) +
+                                                      (max_occupancy_level,))))
+        keys_chunks.append(get_points_keys(x, y))
+        if len(codes_chunks) == 100:
+            codes_chunks = [np.unique(np.concatenate(codes_chunks))]
+            keys_chunks = [np.unique(np.concatenate(keys_chunks))]
         print '\r', i * chunk_size,
         sys.stdout.flush()
     tree.commit()
+    save_occupancy(build_occupancy(codes_chunks), get_occupancy_filename(temp_dir))
+    keys = np.unique(np.concatenate(keys_chunks)) if keys_chunks else np.zeros(0, dtype=np.uint64)
+    np.save(get_points_filename(temp_dir), keys)
     return tree
 
 
 def main():
+    global vector_tile_format, vector_tile_max_zoom, png_compress_level
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--tiles-db', required=True)
     parser.add_argument('-p', '--photo-db', required=True)
     parser.add_argument('-t', '--temp-dir', required=True)
+    parser.add_argument('-s', '--snapshot', help='columnar snapshot made by export_snapshot.py, used instead of photo db')
+    parser.add_argument('-j', '--processes', type=int, default=1, help='render tiles in parallel processes')
+    parser.add_argument('--split-level', type=int, default=6,
+                        help='with several processes, subtrees of tiles at this zoom are rendered in parallel')
+    parser.add_argument('-u', '--update', action='store_true',
+                        help='render again only tiles changed since previous build of tiles db, '
+                             'points are still sorted and indexed in full')
+    parser.add_argument('--vector-format', type=int, choices=[1, 2],
+                        help='defaults to 1 for new tiles db and to format of existing tiles on update')
+    parser.add_argument('--vector-max-zoom', type=int,
+                        help='quantize format 2 vector tiles for showing up to this zoom')
+    parser.add_argument('--png-level', type=int, choices=range(10), default=png_compress_level,
+                        help='zlib compression level of raster tiles')
     conf = parser.parse_args()
+    vector_tile_format = conf.vector_format or 1
+    vector_tile_max_zoom = conf.vector_max_zoom
+    png_compress_level = conf.png_level
+    if conf.update:
+        if not os.path.exists(get_tiles_points_filename(conf.tiles_db)):
+            raise Exception('Points of previous build of %s not found' % conf.tiles_db)
+        # clean tiles are kept, so tiles rendered again must be of the same format
+        writer = MBTilesWriter(conf.tiles_db)
+        vector_tile_format = int(writer.get_metadata().get('vector_format', 1))
+        writer.close()
+        if conf.vector_format not in (None, vector_tile_format):
+            raise Exception('Tiles in %s have vector format %d, rebuild them to change format' %
+                            (conf.tiles_db, vector_tile_format))
 
     if not os.path.exists(conf.temp_dir):
         os.makedirs(conf.temp_dir)
 
     print 'Sorting'
     t = time.time()
-    sorted_db = build_sorted_points_db(conf.photo_db, conf.temp_dir)
+    if conf.snapshot:
+        points = iterate_snapshot_sorted_points(conf.snapshot)
+    else:
+        sorted_db = build_sorted_points_db(conf.photo_db, conf.temp_dir)
+        points = iterate_sorted_points(sorted_db)
     print
     print time.time() - t
 
     print 'Indexing'
     t = time.time()
-    tree = build_tree(sorted_db, conf.temp_dir)
+    tree = build_tree(points, conf.temp_dir)
     print
     print time.time() - t
-    del sorted_db
+    del points
 
     print 'Making tiles'
     t = time.time()
-    make_tiles(tree, conf.tiles_db)
+    occupancy = load_occupancy(get_occupancy_filename(conf.temp_dir))
+    points_filename = get_points_filename(conf.temp_dir)
+    if conf.update:
+        keys = np.load(points_filename)
+        prev_keys = np.load(get_tiles_points_filename(conf.tiles_db))
+        changed_keys = np.concatenate([np.setdiff1d(keys, prev_keys, assume_unique=True),
+                                       np.setdiff1d(prev_keys, keys, assume_unique=True)])
+        del keys, prev_keys
+        print 'Changed points:', len(changed_keys)
+        update_tiles(tree, conf.tiles_db, get_dirty_tiles(changed_keys), conf.processes, conf.temp_dir,
+                     conf.split_level, occupancy)
+    else:
+        make_tiles(tree, conf.tiles_db, conf.processes, conf.temp_dir, conf.split_level, occupancy)
+    writer = MBTilesWriter(conf.tiles_db)
+    writer.set_metadata(get_tiles_metadata(occupancy))
+    writer.close()
+    shutil.copy(points_filename, get_tiles_points_filename(conf.tiles_db))
     print
     print time.time() - t
     tree.close()
 
 
+def check_build_tree():
+    # points in all quadrants, including ones whose ids collided when y was packed signed
+    points = [(x, y) for x in (-20037508, -1, 0, 1, 20037508) for y in (-20037508, -2, -1, 0, 1, 20037508)]
+    points += [(5, -1), (4, -1), (5, 2 ** 31 - 1)]
+    temp_dir = tempfile.mkdtemp()
+    try:
+        tree = build_tree(iter(points), temp_dir)
+        stored = tree.execute('SELECT minx, miny FROM point').fetchall()
+        assert sorted(stored) == sorted(set(points))
+        keys = np.load(get_points_filename(temp_dir))
+        assert len(keys) == len(set(points))
+        tree.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def draw_raster_tile_by_pastes(points, tile_bounds):
+    # pastes symbol for every point, as tiles were drawn before
+    tile_min_x, tile_min_y, tile_size = tile_bounds
+    im = Image.new('L', (256, 256), 0)
+    r = symbol_radius
+    for x, y in points:
+        pix_x = int((x - tile_min_x) / tile_size * 256)
+        pix_y = int(256 - (y - tile_min_y) / tile_size * 256)
+        im.paste(255, (pix_x - r, pix_y - r, pix_x + r + 1, pix_y + r + 1), mask=get_symbol())
+    return np.asarray(im, dtype=np.int16)
+
+
+def check_draw_raster_tile():
+    tile_bounds = (0., 0., 256.)
+    rnd = np.random.RandomState(0)
+
+    def get_diff(points):
+        im = Image.open(StringIO(draw_raster_tile(points, tile_bounds)))
+        return np.abs(np.asarray(im.split()[-1], dtype=np.int16) - draw_raster_tile_by_pastes(points, tile_bounds))
+
+    # many points in one pixel, pastes with small alpha at symbol edge stop changing pixel far below 255
+    stacks = np.repeat([[30.5, 30.5], [60.5, 30.5], [200.5, 50.5]], [3, 40, 1000], axis=0)
+    assert get_diff(stacks).max() == 0
+    # Overlapping symbols are pasted in other order, result of pastes depends on it.
+    # Dense cluster and sparse points:
+    points = np.concatenate([rnd.normal(100, 3, (20000, 2)), rnd.uniform(-10, 266, (300, 2))])
+    assert get_diff(points).max() <= 2
+
+
+def check():
+    check_build_tree()
+    check_draw_raster_tile()
+    print 'OK'
+
+
 if __name__ == '__main__':
-    main()
-    print 'Done'
+    if sys.argv[1:] == ['--check']:
+        check()
+    else:
+        main()
+        print 'Done'
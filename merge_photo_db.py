@@ -0,0 +1,65 @@
+# coding: utf-8
+# Merges photos dbs written by separate downloaders into one photos db.
+# Owner ids are local to each db, so rows are repacked with owners table of destination db.
+# If photo is in several dbs, the most recently fetched row is kept.
+import sys
+import os
+import time
+import leveldb
+import argparse
+from lib.photo_data import unpack_row, pack_photo, OwnerTable, get_owners_db_filename
+
+
+def open_owners(photo_db_filename):
+    owners_db_filename = get_owners_db_filename(photo_db_filename)
+    if os.path.exists(owners_db_filename):
+        return OwnerTable(owners_db_filename)
+    return None
+
+
+def merge(photo_db_filename, src_db_filenames):
+    for filename in src_db_filenames:
+        if not os.path.isdir(filename):
+            raise Exception('%s not found' % filename)
+    db = leveldb.LevelDB(photo_db_filename, max_open_files=100)
+    owners = OwnerTable(get_owners_db_filename(photo_db_filename))
+    for src_db_filename in src_db_filenames:
+        print 'Merging', src_db_filename
+        src_db = leveldb.LevelDB(src_db_filename, max_open_files=100)
+        src_owners = open_owners(src_db_filename)
+        batch = leveldb.WriteBatch()
+        merged_n = 0
+        for i, (k, v) in enumerate(src_db.RangeIter(fill_cache=False), 1):
+            photo = unpack_row(v, src_owners)
+            # keys are unique in source db, so rows in batch not written yet are not needed here
+            try:
+                old_photo = unpack_row(db.Get(k), owners)
+            except KeyError:
+                old_photo = None
+            if old_photo is None or old_photo.fetch_ts <= photo.fetch_ts:
+                batch.Put(k, pack_photo(photo, owners))
+                merged_n += 1
+            if i % 10000 == 0:
+                owners.flush()
+                db.Write(batch)
+                batch = leveldb.WriteBatch()
+                print '\r', i, merged_n,
+                sys.stdout.flush()
+        owners.flush(sync=True)
+        db.Write(batch, sync=True)
+        print
+        print 'Merged', merged_n, 'rows'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--photo-db', required=True, help='destination photos db, created if missing')
+    parser.add_argument('sources', nargs='+', metavar='SRC_PHOTO_DB', help='photos dbs to merge')
+    conf = parser.parse_args()
+    t = time.time()
+    merge(conf.photo_db, conf.sources)
+    print time.time() - t
+
+
+if __name__ == '__main__':
+    main()
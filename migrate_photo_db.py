@@ -0,0 +1,46 @@
+# coding: utf-8
+# Converts rows of photos db from pickled tuples to compact binary format (see lib/photo_data.py)
+import sys
+import os
+import time
+import leveldb
+import argparse
+from lib.photo_data import is_row_current, repack_row, OwnerTable, get_owners_db_filename
+
+
+def migrate(photo_db_filename):
+    if not os.path.isdir(photo_db_filename):
+        raise Exception('%s not found' % photo_db_filename)
+    db = leveldb.LevelDB(photo_db_filename, max_open_files=100)
+    owners = OwnerTable(get_owners_db_filename(photo_db_filename))
+    batch = leveldb.WriteBatch()
+    converted_n = 0
+    for i, (k, v) in enumerate(db.RangeIter(fill_cache=False), 1):
+        if not is_row_current(v):
+            batch.Put(k, repack_row(v, owners))
+            converted_n += 1
+        if i % 10000 == 0:
+            owners.flush()
+            db.Write(batch)
+            batch = leveldb.WriteBatch()
+            print '\r', i, converted_n,
+            sys.stdout.flush()
+    owners.flush(sync=True)
+    db.Write(batch, sync=True)
+    print
+    print 'Converted', converted_n, 'rows'
+    print 'Compacting'
+    db.CompactRange()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--photo-db', required=True)
+    conf = parser.parse_args()
+    t = time.time()
+    migrate(conf.photo_db)
+    print time.time() - t
+
+
+if __name__ == '__main__':
+    main()